@@ -7,12 +7,34 @@
 # and release builds later than V1.12
 # Under CPython requires CPython 3.8 or later.
 
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+# Link options. A client requests options by appending a tab and the hex value
+# of the option flags to its ID line e.g. 'my_id\t1\n'.
+OPT_ACKBATCH = 1  # Acknowledge several messages with a single line
+OPT_BINARY = 2  # Length prefixed binary frames replace text lines
+OPT_MID16 = 4  # 16 bit message ID's
+
+# Maximum number of qos messages awaiting acknowledgement. ID's must not wrap
+# within the send window or the receiver's de-dupe window.
+WINDOW = 64
+WINDOW16 = 512  # OPT_MID16
+
+# Split a client ID line into the ID and option flags.
+def idopts(line):
+    s = line.split('\t', 1)
+    return s[0], int(s[1], 16) if len(s) > 1 else 0
+
 # Create message ID's. Initially 0 then 1 2 ... 254 255 1 2
-def gmid():
+# With OPT_MID16 mask is 0xffff.
+def gmid(mask=0xff):
     mid = 0
     while True:
         yield mid
-        mid = (mid + 1) & 0xff
+        mid = (mid + 1) & mask
         mid = mid if mid else 1
 
 # Return True if a message ID has not already been received
@@ -27,3 +49,132 @@ def isnew(mid, lst=bytearray(32)):
     lst[idx] |= bit
     lst[(idx + 16 & 0x1f)] = 0
     return res
+
+# De-dupe for 16 bit message ID's (OPT_MID16). Records which of the most recent
+# 1024 ID's have been received, using 128 bytes. Called as per isnew: return
+# True if mid has not already been received, clear the record if mid == -1.
+class MidWindow:
+    def __init__(self, size=1024):  # size must be a power of 2
+        self._ba = bytearray(size >> 3)
+        self._mask = size - 1
+        self._top = -1  # Most recent ID received
+
+    def __call__(self, mid):
+        ba = self._ba
+        top = self._top
+        if mid == -1 or top == -1:
+            for idx in range(len(ba)):
+                ba[idx] = 0
+            self._top = mid
+            if mid == -1:
+                return
+        ahead = (mid - top) & 0xffff
+        if 0 < ahead < 0x8000:  # Slide window forward to mid
+            if ahead > self._mask:
+                for idx in range(len(ba)):
+                    ba[idx] = 0
+            else:  # Forget the ID's which the window passes over
+                while top != mid:
+                    top = (top + 1) & 0xffff
+                    i = top & self._mask
+                    ba[i >> 3] &= ~(1 << (i & 7))
+            self._top = mid
+        elif ((top - mid) & 0xffff) > self._mask:
+            return False  # Older than the window: must be a duplicate
+        i = mid & self._mask
+        bit = 1 << (i & 7)
+        res = not (ba[i >> 3] & bit)
+        ba[i >> 3] |= bit
+        return res
+
+# Retransmit timeout estimation from ACK round trip times as per RFC 6298.
+# Times are integer ms. tmax is the link timeout: this is the initial timeout
+# and limits exponential backoff. Only ACKs of messages sent once are sampled
+# (Karn's algorithm).
+RTO_MIN = 100  # Lower bound: allows for ACK batching and ESP8266 latency
+
+class Rtt:
+    def __init__(self, tmax):
+        self.srtt = 0  # Smoothed RTT. 0: no sample yet
+        self.rttvar = 0  # RTT variation
+        self.rto = tmax  # Retransmit timeout
+        self._tmax = tmax
+
+    def sample(self, rtt):
+        if self.srtt:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) >> 2
+            self.srtt += (rtt - self.srtt) >> 3
+        else:
+            self.srtt = rtt or 1
+            self.rttvar = rtt >> 1
+        self.rto = min(max(self.srtt + 4 * self.rttvar, RTO_MIN), self._tmax)
+
+    def timeout(self, n):  # Timeout after n retransmissions
+        return min(self.rto << n, self._tmax)
+
+# Priority lanes. PRI_HIGH messages are sent ahead of queued PRI_NORMAL ones
+# and may exceed the send window up to the limit set by the message ID size.
+PRI_NORMAL = 0
+PRI_HIGH = 1
+
+# Statistics for a priority lane. Times are integer ms.
+class Lane:
+    __slots__ = ('depth', 'latency', 'maxlat', 'count', 'expired')  # Many per server
+
+    def __init__(self):
+        self.depth = 0  # Messages unsent or awaiting ACK
+        self.latency = 0  # Smoothed time from write to ACK (to send if not qos)
+        self.maxlat = 0  # Longest time from write to ACK
+        self.count = 0  # No. of messages delivered
+        self.expired = 0  # No. of messages discarded when their ttl expired
+
+    def sample(self, t):
+        self.latency = self.latency + ((t - self.latency) >> 3) if self.count else t
+        self.maxlat = max(self.maxlat, t)
+        self.count += 1
+
+# Batched ACK. A line starting with '*' acknowledges a comma separated list of
+# message ID's and inclusive ranges of ID's e.g. '*05-09,0c\n'. Message lines
+# always start with a hex digit so cannot be mistaken for one.
+# Return the ACK line for a list of message ID's in order of receipt.
+# fmt formats a message ID: '{:04x}' with OPT_MID16.
+def ackfmt(mids, fmt='{:02x}'):
+    if len(mids) == 1:
+        return '{}\n'.format(fmt.format(mids[0]))
+    runs = []
+    for mid in mids:
+        if runs and mid == runs[-1][1] + 1:
+            runs[-1][1] = mid  # Extend current range
+        else:
+            runs.append([mid, mid])
+    rfmt = '{}-{}'.format(fmt, fmt)
+    return '*{}\n'.format(','.join([rfmt.format(a, b) if a != b
+                                     else fmt.format(a) for a, b in runs]))
+
+# Given the text of a batched ACK line following the '*' return its ID's.
+def ackids(s):
+    for x in s.split(','):
+        r = x.split('-')
+        yield from range(int(r[0], 16), int(r[-1], 16) + 1)
+
+# Binary frames (OPT_BINARY). A 5 byte header holds the frame type, message ID
+# and payload length. Payloads are arbitrary bytes.
+HDR = '>BHH'
+HDR_LEN = 5
+FT_MSG = 0  # Message
+FT_ACK = 1  # ACK. Payload holds any further ID's acknowledged, 2 bytes each
+FT_KA = 2  # Keepalive
+FT_BRK = 3  # Topic broker request: as a message, the payload is the request
+
+def frame(typ, mid=0, payload=b''):
+    return struct.pack(HDR, typ, mid, len(payload)) + payload
+
+# Return an ACK frame for a list of message ID's.
+def ackframe(mids):
+    n = len(mids) - 1
+    return frame(FT_ACK, mids[0], struct.pack('>{}H'.format(n), *mids[1:])
+                 if n else b'')
+
+# Return the ID's acknowledged by a received ACK frame.
+def frameacks(mid, payload):
+    return (mid,) + struct.unpack('>{}H'.format(len(payload) >> 1), payload)
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# conns.py Measure the per-client cost of the server.
+# Run under CPython 3.8 or later:
+# python3 -m iot.bench.conns [nclients ...]
+# The default is to measure 1000 and 10000 clients.
+
+# Released under the MIT licence. See LICENSE.
+# Copyright (C) micropython-iot contributors 2026
+
+# Simulated clients run in a child process. This opens a socket for each client
+# and sends its ID, but sends nothing further: the timeout is long enough for
+# none to time out. The parent runs the server and reports the number of
+# asyncio tasks and the Python heap memory allocated by iot.server for each
+# Connection. Each process needs a file descriptor per client: the limit may
+# need to be raised with ulimit -n.
+
+import asyncio
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from iot import server
+
+PORT = 8124
+TIMEOUT = 600000  # ms
+
+def nofile():  # Raise file descriptor limit as far as permitted
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def clients(n):  # Child process
+    nofile()
+    socks = []
+    for x in range(n):
+        s = socket.create_connection(('127.0.0.1', PORT))
+        s.sendall('b{}\n'.format(x).encode())
+        socks.append(s)
+    sys.stdin.read()  # Hold the connections until the parent is done
+
+def heap():  # Bytes allocated by iot.server
+    snap = tracemalloc.take_snapshot()
+    snap = snap.filter_traces([tracemalloc.Filter(True, server.__file__, all_frames=True)])
+    return sum(stat.size for stat in snap.statistics('filename'))
+
+async def measure(n):
+    # No expected set: clients are registered as they connect
+    asyncio.create_task(server.run(None, port=PORT, timeout=TIMEOUT))
+    await asyncio.sleep(0.5)
+    tasks = len(asyncio.all_tasks())
+    mem = heap()
+    child = subprocess.Popen([sys.executable, '-m', 'iot.bench.conns', '-c', str(n)],
+                             stdin=subprocess.PIPE)
+    try:
+        deadline = time.monotonic() + 10 + n / 100  # Generous connect time
+        while len(server.Connection._conns) < n:
+            if child.poll() is not None:
+                raise RuntimeError('Client process exited with code {}.'.format(child.returncode))
+            if time.monotonic() > deadline:
+                raise RuntimeError('Only {} of {} clients connected.'.format(
+                    len(server.Connection._conns), n))
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(1)  # Let handshake tasks finish
+        tasks = len(asyncio.all_tasks()) - tasks
+        mem = heap() - mem
+        print('{:6d} clients: {:.2f} tasks {:6.0f} bytes per connection'.format(
+            n, tasks / n, mem / n))
+    finally:
+        child.stdin.close()
+        child.wait()
+        server.Connection.close_all()
+        server.Connection._conns.clear()
+        server.Connection._server_sock = None
+        for slot in server.Connection._wheel:
+            slot.clear()
+
+def main(args):
+    if args[:1] == ['-c']:
+        clients(int(args[1]))
+        return
+    nofile()
+    tracemalloc.start(25)
+    for n in (int(x) for x in args) if args else (1000, 10000):
+        asyncio.run(measure(n))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -21,9 +21,13 @@ import network
 import utime
 import machine
 import uerrno as errno
-from . import gmid, isnew  # __init__.py
+from . import gmid, isnew, MidWindow, ackfmt, ackids  # __init__.py
+from . import frame, ackframe, frameacks, struct, HDR, HDR_LEN, FT_MSG, FT_ACK, FT_KA
+from . import FT_BRK
+from . import OPT_ACKBATCH, OPT_BINARY, OPT_MID16, WINDOW, WINDOW16, Rtt
+from . import PRI_NORMAL, PRI_HIGH, Lane
 from .primitives import launch
-from .primitives.queue import Queue, QueueFull
+from .primitives.queue import Queue
 gc.collect()
 from micropython import const
 
@@ -32,6 +36,7 @@ WDT_CB = const(-3)
 
 # Message ID generator. Only need one instance on client.
 getmid = gmid()
+KA_FRAME = frame(FT_KA)  # OPT_BINARY keepalive
 gc.collect()
 
 # Minimal implementation of set for integers in range 0-255
@@ -39,21 +44,26 @@ gc.collect()
 # based on Events rather than polling.
 
 
+# With OPT_MID16 integers are stored modulo the set size (8 * nbytes).
 class ASetByte:
-    def __init__(self):
-        self._ba = bytearray(32)
+    def __init__(self, nbytes=32):
+        self._ba = bytearray(nbytes)
+        self._mask = 8 * nbytes - 1
         self._evdis = asyncio.Event()  # Discard event
 
     def __bool__(self):
         return any(self._ba)
 
     def __contains__(self, i):
+        i &= self._mask
         return (self._ba[i >> 3] & 1 << (i & 7)) > 0
 
     def add(self, i):
+        i &= self._mask
         self._ba[i >> 3] |= 1 << (i & 7)
 
     def discard(self, i):
+        i &= self._mask
         self._ba[i >> 3] &= ~(1 << (i & 7))
         self._evdis.set()
 
@@ -67,14 +77,34 @@ class Client:
     def __init__(self, my_id, server, port=8123,
                  ssid='', pw='', timeout=2000,
                  conn_cb=None, conn_cb_args=None,
-                 verbose=False, led=None, wdog=False):
-        self._my_id = '{}{}'.format(my_id, '\n')  # Ensure >= 1 newline
+                 verbose=False, led=None, wdog=False, window=1,
+                 ackbatch=False, flush_ms=0, binary=False, mid16=False):
+        maxwin = WINDOW16 if mid16 else WINDOW
+        if not 0 < window <= maxwin:  # Message ID's must not wrap within window
+            raise ValueError('window must be in range 1-{}'.format(maxwin))
+        # Link options
+        self._opts = ((OPT_ACKBATCH if ackbatch else 0) | (OPT_BINARY if binary else 0)
+                      | (OPT_MID16 if mid16 else 0))
+        if mid16:
+            self._getmid = gmid(0xffff)  # Message ID generator
+            self._isnew = MidWindow()  # De-dupe
+            self._mfmt = '{:04x}'  # Message ID format (text mode)
+        else:
+            self._getmid = getmid
+            self._isnew = isnew
+            self._mfmt = '{:02x}'
+        self._nd = len(self._mfmt.format(0))  # No. of hex digits in ID
+        if self._opts:  # Request options from server
+            self._my_id = '{}\t{:x}\n'.format(my_id, self._opts)
+        else:
+            self._my_id = '{}{}'.format(my_id, '\n')  # Ensure >= 1 newline
         self._server = server
         self._ssid = ssid
         self._pw = pw
         self._port = port
         self._to = timeout  # Client and server timeout
         self._tim_ka = timeout // 4  # Keepalive interval
+        self._flush_ms = flush_ms  # Max delay before queued data is sent
         self._concb = conn_cb
         self._concbargs = () if conn_cb_args is None else conn_cb_args
         self._verbose = verbose
@@ -132,12 +162,23 @@ class Client:
         self._evfail = asyncio.Event()  # Set by any comms failure
         self._evok = asyncio.Event()  # Set by 1st successful read
         self._s_lock = asyncio.Lock()  # For internal send conflict.
-        self._w_lock = asyncio.Lock()  # For .write rate limit
+        self._window = window  # Max no. of waiting qos writes in flight
+        self._maxwin = maxwin  # Limit for PRI_HIGH writes
+        self._nwin = 0  # Current no. of waiting qos writes in flight
+        self._nhiw = 0  # No. of PRI_HIGH writes waiting for the window
+        self.lanes = (Lane(), Lane())  # Statistics: index is priority
+        self._evwin = asyncio.Event()  # Set when a write leaves the window
         self._last_wr = utime.ticks_ms()
         self._lineq = Queue(20)  # 20 entries
         self.connects = 0  # Connect count for test purposes/app access
+        self.rtt = Rtt(timeout)  # Round trip time statistics
         self._sock = None
-        self._acks_pend = ASetByte()  # ACKs which are expected to be received
+        # ACKs which are expected to be received. Must hold the send window.
+        self._acks_pend = ASetByte(128 if mid16 else 32)
+        self._keys = {}  # Conflation. index: key. value: [mid] of latest write
+        self._ackq = []  # OPT_ACKBATCH: ID's of messages awaiting our ACK
+        self._outq = []  # Lines awaiting transmission
+        self._evout = asyncio.Event()  # Set when data is queued
         gc.collect()
         asyncio.create_task(self._run())
 
@@ -151,23 +192,117 @@ class Client:
     __call__ = status
 
     async def readline(self):
-        return await self._lineq.get()
-
-    async def write(self, buf, qos=True, wait=True):
-        if qos and wait:  # Disallow concurrent writes
-            await self._w_lock.acquire()
+        line = await self._lineq.get()
+        if self._opts & OPT_BINARY:
+            return '{}{}'.format(line.decode(), '\n')
+        return line
+
+    # Return a message as bytes. With binary=True these are as sent by the
+    # server, otherwise they are the encoded line without a newline.
+    async def read_bytes(self):
+        line = await self._lineq.get()
+        if self._opts & OPT_BINARY:
+            return line
+        return line[:-1].encode()
+
+    # If key is not None a message with the same key which is unsent or
+    # unacknowledged is discarded: its write returns at once.
+    # PRI_HIGH writes take precedence over PRI_NORMAL writes waiting for the
+    # window and may exceed it. A message not acknowledged within ttl ms is
+    # discarded. Return False if the message was discarded.
+    async def write(self, buf, qos=True, wait=True, key=None, pri=PRI_NORMAL, ttl=0):
+        if self._opts & OPT_BINARY:  # Send text as a bytes payload
+            buf = (buf[:-1] if buf.endswith('\n') else buf).encode()
+        return await self._wmsg(buf, qos, wait, key, pri, ttl)
+
+    # With binary=True buf may contain any bytes. Otherwise it is sent as a
+    # line of text.
+    async def write_bytes(self, buf, qos=True, wait=True, key=None, pri=PRI_NORMAL, ttl=0):
+        if not self._opts & OPT_BINARY:
+            buf = buf.decode()
+        return await self._wmsg(buf, qos, wait, key, pri, ttl)
+
+    # Topic broker (server run with broker=True). Subscribers receive
+    # '<topic>\t<buf>'. buf is as per write or write_bytes.
+    async def publish(self, topic, buf, qos=True, wait=True, key=None, pri=PRI_NORMAL, ttl=0):
+        return await self._request('>{}\t'.format(topic), buf, qos, wait, key, pri, ttl)
+
+    async def subscribe(self, topic):
+        return await self._request('+' + topic, '')
+
+    async def unsubscribe(self, topic):
+        return await self._request('-' + topic, '')
+
+    # A request is sent as an FT_BRK frame or as a line starting with a tab.
+    async def _request(self, req, buf, qos=True, wait=True, key=None, pri=PRI_NORMAL, ttl=0):
+        if self._opts & OPT_BINARY:
+            if isinstance(buf, str):
+                buf = (buf[:-1] if buf.endswith('\n') else buf).encode()
+            return await self._wmsg(req.encode() + buf, qos, wait, key, pri, ttl, FT_BRK)
+        if not isinstance(buf, str):
+            buf = buf.decode()
+        return await self._wmsg('\t' + req + buf, qos, wait, key, pri, ttl)
+
+    async def _wmsg(self, buf, qos, wait, key, pri, ttl, typ=FT_MSG):
+        lane = self.lanes[pri]
+        lane.depth += 1
+        t = utime.ticks_ms()
+        cell = None
+        if key is not None or ttl:  # cell identifies this write
+            cell = [-1, t, ttl]  # Message ID once assigned, time written, ttl
+            if key is not None:  # Conflate
+                old = self._keys.get(key)
+                self._keys[key] = cell
+                if old is not None:  # Supersede it
+                    if old[0] != -1:
+                        self._acks_pend.discard(old[0])
+                    self._evwin.set()  # It may be waiting for the window
+        win = False
         try:  # In case of cancellation/timeout
-            # Prepend message ID to a copy of buf
-            fstr = '{:02x}{}' if buf.endswith('\n') else '{:02x}{}\n'
-            mid = next(getmid)
+            if qos and wait:  # Pause until the window has space
+                lim = self._maxwin if pri else self._window
+                while self._nwin >= lim or not pri and self._nhiw:
+                    if self._stale(key, cell):
+                        return self._drop(lane, key, cell)
+                    self._nhiw += pri
+                    self._evwin.clear()
+                    try:
+                        await self._await(self._evwin, cell)
+                    finally:
+                        self._nhiw -= pri
+                self._nwin += 1
+                win = True
+            mid = next(self._getmid)
             self._acks_pend.add(mid)
-            buf = fstr.format(mid, buf)
-            await self._write(buf)
-            if qos:  # Return when an ACK received
-                await self._do_qos(mid, buf)
+            if cell is not None:
+                cell[0] = mid
+            if self._opts & OPT_BINARY:
+                buf = frame(typ, mid, buf)
+            else:  # Prepend message ID to a copy of buf
+                fstr = '{}{}' if buf.endswith('\n') else '{}{}\n'
+                buf = fstr.format(self._mfmt.format(mid), buf)
+            if not await self._write(buf, key, cell):  # Superseded or expired
+                self._acks_pend.discard(mid)
+                return self._drop(lane, key, cell)
+            # qos: return when an ACK received
+            if qos and not await self._do_qos(mid, buf, key, cell):
+                return self._drop(lane, key, cell)
+            lane.sample(utime.ticks_diff(utime.ticks_ms(), t))
+            return True
         finally:
-            if qos and wait:
-                self._w_lock.release()
+            lane.depth -= 1
+            if win:
+                self._nwin -= 1
+                self._evwin.set()
+            if key is not None and self._keys.get(key) is cell:
+                del self._keys[key]
+
+    # A write was superseded or has expired.
+    def _drop(self, lane, key, cell):
+        if not self._superseded(key, cell):
+            lane.expired += 1
+            self._verbose and print('Message expired')
+        return False
 
     def close(self):
         self._close()  # Close socket and WDT
@@ -207,31 +342,100 @@ class Client:
                 return True
         return False
 
-    async def _write(self, line):
-        while True:
-            # After an outage wait until something is received from server
-            # before we send.
-            await self._evok.wait()
-            if await self._send(line):
-                return
+    # After an outage wait until something is received from server before we
+    # send. Return False if superseded or expired in the meantime.
+    async def _write(self, line, key=None, cell=None):
+        if not await self._linkup(key, cell) or self._stale(key, cell):
+            return False
+        self._out(line)
+        return True
+
+    # Wait for any outage to clear. Return False if the write's ttl expires
+    # first.
+    async def _linkup(self, key, cell):
+        while not self._evok.is_set():
+            if self._stale(key, cell):
+                return False
+            await self._await(self._evok, cell)
+        return True
 
-            # send fail. _send has triggered _evfail. .run clears _evok.
-            await asyncio.sleep_ms(0)  # Ensure .run is scheduled
+    # Wait for an Event. If the write has a ttl stop waiting when it expires.
+    async def _await(self, ev, cell):
+        if cell is None or not cell[2]:
+            await ev.wait()
+            return
+        to = cell[2] - utime.ticks_diff(utime.ticks_ms(), cell[1])
+        try:
+            await asyncio.wait_for_ms(ev.wait(), max(to, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    # Conflation: True if a write with the same key has superseded this one.
+    def _superseded(self, key, cell):
+        return key is not None and self._keys.get(key) is not cell
+
+    # True if a write has been superseded or its ttl has expired.
+    def _stale(self, key, cell):
+        if cell is None:
+            return False
+        return self._superseded(key, cell) or (
+            cell[2] and utime.ticks_diff(utime.ticks_ms(), cell[1]) >= cell[2])
+
+    # Queue a line for transmission. Lines queued before the flusher runs are
+    # sent with a single socket write. Lines queued when a send fails are
+    # lost: qos messages are retransmitted.
+    def _out(self, line):
+        self._outq.append(line)
+        self._evout.set()
+
+    async def _flusher(self):
+        while True:
+            await self._evout.wait()
+            self._evout.clear()
+            await asyncio.sleep_ms(self._flush_ms)  # Allow more to be queued
+            q = self._outq
+            self._outq = []
+            binary = self._opts & OPT_BINARY
+            if self._ackq:  # Acknowledge all received messages
+                q.append(ackframe(self._ackq) if binary
+                         else ackfmt(self._ackq, self._mfmt))
+                self._ackq = []
+            if q:
+                # error sets ._evfail, .run cancels this coro
+                await self._send((b'' if binary else '').join(q))
 
     # Handle qos. Retransmit until matching ACK received.
-    # ACKs typically take 200-400ms to arrive.
-    async def _do_qos(self, mid, line):
+    # ACKs typically take 200-400ms to arrive. The timeout is based on the
+    # measured RTT and doubles with each retry.
+    # Return False if the message was superseded or expired.
+    async def _do_qos(self, mid, line, key=None, cell=None):
+        t = utime.ticks_ms()
+        connects = self.connects
+        n = 0  # Retransmissions
         while True:
-            # Wait for any outage to clear
-            await self._evok.wait()
+            if not await self._linkup(key, cell):  # Expired during an outage
+                self._acks_pend.discard(mid)
+                return False
+            to = self.rtt.timeout(n)
+            if cell is not None and cell[2]:  # Stop waiting when ttl expires
+                to = max(min(to, cell[2] - utime.ticks_diff(utime.ticks_ms(), cell[1])), 0)
             # Wait for the matching ACK.
             try:
-                await asyncio.wait_for_ms(self._acks_pend.has_not(mid), self._to)
+                await asyncio.wait_for_ms(self._acks_pend.has_not(mid), to)
             except asyncio.TimeoutError:  # Ack was not received - re-send
-                await self._write(line)
+                if not await self._write(line, key, cell):
+                    self._acks_pend.discard(mid)  # Drop from retransmit set
+                    return False
+                n += 1
                 self._verbose and print('Repeat', line, 'to server app')
             else:
-                return  # Got ack
+                if self._superseded(key, cell):
+                    return False
+                # Sample the RTT unless the message was resent or an outage
+                # intervened.
+                if not n and connects == self.connects:
+                    self.rtt.sample(utime.ticks_diff(utime.ticks_ms(), t))
+                return True  # Got ack
 
     # Make an attempt to connect to WiFi. May not succeed.
     async def _connect(self, s):
@@ -288,8 +492,11 @@ class Client:
                 tsk_reader = asyncio.create_task(self._reader())
                 # Server reads ID immediately, but a brief pause is probably wise.
                 await asyncio.sleep_ms(50)
+                self._outq = []  # Discard data queued for previous socket
+                self._ackq = []
                 if await self._send(self._my_id):
                     tsk_ka = asyncio.create_task(self._keepalive())
+                    tsk_fl = asyncio.create_task(self._flusher())
                     if self._concb is not None:
                         # apps might need to know connection to the server acquired
                         launch(self._concb, True, *self._concbargs)
@@ -297,6 +504,7 @@ class Client:
                     self._evok.clear()
                     tsk_reader.cancel()
                     tsk_ka.cancel()
+                    tsk_fl.cancel()
                     await asyncio.sleep_ms(0)  # wait for cancellation
                     self._feed(0)  # _concb might block (I hope not)
                     if self._concb is not None:
@@ -317,46 +525,63 @@ class Client:
     async def _reader(self):  # Entry point is after a (re) connect.
         c = self.connects  # Count successful connects
         to = 2 * self._to  # Extend timeout on 1st pass for slow server
+        binary = self._opts & OPT_BINARY
         while True:
             try:
-                line = await self._readline(to)  # OSError on fail
+                if binary:
+                    typ, mid, line = await self._readframe(to)
+                else:
+                    line = await self._readline(to)  # OSError on fail
             except OSError:
                 self._verbose and print('reader fail')
                 self._evfail.set()  # ._run cancels other coros
                 return
 
             to = self._to
-            mid = int(line[0:2], 16)
-            if len(line) == 3:  # Got ACK: remove from expected list
-                self._acks_pend.discard(mid)  # qos0 acks are ignored
-                continue  # All done
+            if binary:
+                if typ == FT_ACK:
+                    for mid in frameacks(mid, line):
+                        self._acks_pend.discard(mid)
+                    continue
+            else:
+                if line[0] == 0x2a:  # '*' Batched ACK
+                    for mid in ackids(line[1:-1].decode()):
+                        self._acks_pend.discard(mid)
+                    continue
+                nd = self._nd
+                mid = int(line[0:nd], 16)
+                if len(line) == nd + 1:  # Got ACK: remove from expected list
+                    self._acks_pend.discard(mid)  # qos0 acks are ignored
+                    continue  # All done
+                line = line[nd:].decode()
+            # If the application has not made space, don't ACK: the server
+            # retransmits the message later.
+            if self._lineq.full():
+                continue
             # Message received & can be passed to user: send ack.
-            asyncio.create_task(self._sendack(mid))
+            if self._opts & (OPT_ACKBATCH | OPT_BINARY):
+                # Lines already received are processed before the flusher
+                # runs, so they share a single ACK line.
+                self._ackq.append(mid)
+                self._evout.set()
+            else:
+                self._out('{}\n'.format(self._mfmt.format(mid)))
             # Discard dupes. mid == 0 : Server has power cycled
             if not mid:
-                isnew(-1)  # Clear down rx message record
-            if isnew(mid):
-                try:
-                    self._lineq.put_nowait(line[2:].decode())
-                except QueueFull:
-                    self._verbose and print('_reader fail. Overflow.')
-                    self._evfail.set()
-                    return
+                self._isnew(-1)  # Clear down rx message record
+            if self._isnew(mid):
+                self._lineq.put_nowait(line)
             if c == self.connects:
                 self.connects += 1  # update connect count
 
-    async def _sendack(self, mid):
-        await self._send('{:02x}\n'.format(mid))
-
     async def _keepalive(self):
         while True:
             due = self._tim_ka - \
                 utime.ticks_diff(utime.ticks_ms(), self._last_wr)
             if due <= 0:
-                # error sets ._evfail, .run cancels this coro
-                await self._send(b'\n')
-            else:
-                await asyncio.sleep_ms(due)
+                self._out(KA_FRAME if self._opts & OPT_BINARY else '\n')
+                due = self._tim_ka
+            await asyncio.sleep_ms(due)
 
     # Read a line from nonblocking socket: reads can return partial data which
     # are joined into a line. Blank lines are keepalive packets which reset
@@ -395,6 +620,43 @@ class Client:
                 start = utime.ticks_ms()
                 line = b''.join((line, d)) if line else d
 
+    # OPT_BINARY: read a frame from nonblocking socket. Keepalive frames reset
+    # the timeout. Return (type, message ID, payload).
+    async def _readframe(self, to):
+        led = self._led
+        while True:
+            typ, mid, n = struct.unpack(HDR, await self._readn(HDR_LEN, to))
+            payload = await self._readn(n, to) if n else b''
+            self._evok.set()  # Got at least 1 packet after an outage.
+            if typ != FT_KA:
+                return typ, mid, payload
+            # Got a keepalive: discard, reset timers, toggle LED.
+            self._feed(0)
+            if led is not None:
+                if isinstance(led, machine.Pin):
+                    led(not led())
+                else:  # On Pyboard D
+                    led.toggle()
+
+    # Read n bytes. Timeout applies to the interval between received data.
+    async def _readn(self, n, to):
+        buf = b''
+        start = utime.ticks_ms()
+        while len(buf) < n:
+            d = self._sock.read(n - len(buf))
+            if d == b'':
+                self._verbose and print('_readframe peer disconnect')
+                raise OSError
+            if d is None:  # Nothing received: wait on server
+                if utime.ticks_diff(utime.ticks_ms(), start) > to:
+                    self._verbose and print('_readframe timeout')
+                    raise OSError
+                await asyncio.sleep_ms(0)
+            else:  # Something received: reset timer
+                start = utime.ticks_ms()
+                buf = b''.join((buf, d)) if buf else d
+        return buf
+
     async def _send(self, d):  # Write a line to socket.
         async with self._s_lock:
             start = utime.ticks_ms()
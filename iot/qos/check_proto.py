@@ -0,0 +1,88 @@
+# check_proto.py Test the protocol helpers shared by client and server.
+
+# Released under the MIT licence. See LICENSE.
+# Copyright (C) micropython-iot contributors 2026
+
+# Runs under CPython or MicroPython without a network:
+# python3 -m iot.qos.check_proto
+# On a target: import iot.qos.check_proto
+# An AssertionError identifies any failing check.
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+from iot import (MidWindow, Rtt, RTO_MIN, ackfmt, ackids, ackframe, frameacks,
+                 HDR, HDR_LEN, FT_ACK)
+
+def mid_window():
+    w = MidWindow()
+    assert w(7) and not w(7)  # First ID is accepted, a repeat is not
+    assert w(5) and not w(5)  # Out of order but within the window
+    w(-1)  # Peer has power cycled
+    assert w(7)
+    # Wraparound: gmid(0xffff) goes ... 0xfffe 0xffff 1 2
+    w = MidWindow()
+    for mid in (0xfffe, 0xffff, 1, 2):
+        assert w(mid)
+    for mid in (0xfffe, 0xffff, 1, 2):  # Dupes across the wrap
+        assert not w(mid)
+    assert w(0xfffd)  # Not yet seen and still within the window
+    # Older than the window: assumed to be a dupe
+    w = MidWindow()
+    assert w(2000)
+    assert not w(2000 - 1024) and w(2000 - 1023)
+    # Jump forward by more than the window: the record is cleared
+    assert w(5000) and not w(5000)
+    assert not w(2000)
+    print('MidWindow OK')
+
+def ack_text():
+    assert ackfmt([5]) == '05\n'
+    assert ackfmt([0x12], '{:04x}') == '0012\n'
+    mids = [1, 2, 3, 5, 7, 8]
+    line = ackfmt(mids)
+    assert line == '*01-03,05,07-08\n'
+    assert list(ackids(line[1:-1])) == mids
+    mids = [0xfe, 0xff, 1, 2]  # 8 bit ID's wrap to 1
+    line = ackfmt(mids)
+    assert line == '*fe-ff,01-02\n'
+    assert list(ackids(line[1:-1])) == mids
+    mids = [9, 4, 5]  # Order of receipt is preserved
+    line = ackfmt(mids, '{:04x}')
+    assert line == '*0009,0004-0005\n'
+    assert list(ackids(line[1:-1])) == mids
+    print('ackfmt/ackids OK')
+
+def ack_frame():
+    for mids in ([3], [1, 2, 3, 0xffff, 1], list(range(100, 300))):
+        buf = ackframe(mids)
+        typ, mid, n = struct.unpack(HDR, buf[:HDR_LEN])
+        assert typ == FT_ACK and n == len(buf) - HDR_LEN
+        assert list(frameacks(mid, buf[HDR_LEN:])) == mids
+    print('ackframe/frameacks OK')
+
+def rtt():
+    r = Rtt(2000)
+    assert r.rto == 2000 and r.timeout(3) == 2000  # No sample yet
+    r.sample(200)
+    assert (r.srtt, r.rttvar, r.rto) == (200, 100, 600)
+    r.sample(300)
+    assert (r.srtt, r.rttvar, r.rto) == (212, 100, 612)
+    assert r.timeout(0) == 612 and r.timeout(1) == 1224
+    assert r.timeout(2) == 2000  # Backoff is limited by the link timeout
+    r = Rtt(2000)
+    r.sample(10)
+    assert r.rto == RTO_MIN
+    r = Rtt(2000)
+    r.sample(0)
+    assert r.srtt == 1  # A zero RTT still counts as a sample
+    r = Rtt(500)
+    r.sample(400)
+    assert r.rto == 500
+    print('Rtt OK')
+
+mid_window()
+ack_text()
+ack_frame()
+rtt()
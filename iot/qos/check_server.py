@@ -0,0 +1,409 @@
+# check_server.py Loopback tests of the server. CPython only.
+
+# Released under the MIT licence. See LICENSE.
+# Copyright (C) micropython-iot contributors 2026
+
+# Each test runs iot.server on a local port and talks to it through simulated
+# clients which speak the protocol over asyncio streams. Run all tests with
+# python3 -m iot.qos.check_server
+# or name the tests to run e.g.
+# python3 -m iot.qos.check_server window relay
+# An AssertionError identifies any failing check.
+
+import asyncio
+import struct
+import sys
+from iot import server, frame, frameacks, ackids, HDR, HDR_LEN
+from iot import FT_MSG, FT_ACK, FT_KA, FT_BRK, OPT_BINARY, OPT_MID16
+from iot import PRI_NORMAL, PRI_HIGH
+
+PORT = 8125
+TIMEOUT = 1000  # ms: outages are detected quickly
+
+# A simulated client. opts are the link options it requests. Received messages
+# are ACKed unless .ack is False, in which case .unacked holds their ID's.
+# Messages are de-duplicated and put on .rxq as payload bytes.
+class Peer:
+    def __init__(self, cid, opts=0):
+        self.cid = cid
+        self.opts = opts
+        self.ack = True
+        self.unacked = []
+        self.acks = set()  # ID's acknowledged by the server
+        self.rxq = asyncio.Queue()
+        self._seen = set()
+        self._mid = 0
+        self._nd = 4 if opts & OPT_MID16 else 2
+        self._tasks = ()
+
+    async def start(self):
+        self._r, self._w = await asyncio.open_connection('127.0.0.1', PORT)
+        opts = '\t{:x}'.format(self.opts) if self.opts else ''
+        self._w.write('{}{}\n'.format(self.cid, opts).encode())
+        self._tasks = (asyncio.create_task(self._read()),
+                       asyncio.create_task(self._keepalive()))
+        return self
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._w.close()
+
+    def silence(self):  # Stop keepalives: the server detects an outage
+        self._tasks[1].cancel()
+
+    async def _keepalive(self):
+        ka = frame(FT_KA) if self.opts & OPT_BINARY else b'\n'
+        while True:
+            self._w.write(ka)
+            await asyncio.sleep(TIMEOUT / 4000)
+
+    async def _read(self):
+        nd = self._nd
+        while True:
+            if self.opts & OPT_BINARY:
+                try:
+                    typ, mid, n = struct.unpack(HDR, await self._r.readexactly(HDR_LEN))
+                    payload = await self._r.readexactly(n)
+                except asyncio.IncompleteReadError:  # Server closed the connection
+                    return
+                if typ == FT_ACK:
+                    self.acks.update(frameacks(mid, payload))
+                    continue
+                if typ != FT_MSG:
+                    continue
+            else:
+                line = await self._r.readline()
+                if not line:  # Server closed the connection
+                    return
+                line = line[:-1]
+                if not line:  # Keepalive
+                    continue
+                if line[0] == 0x2a:  # '*' Batched ACK
+                    self.acks.update(ackids(line[1:].decode()))
+                    continue
+                mid = int(line[:nd], 16)
+                if len(line) == nd:
+                    self.acks.add(mid)
+                    continue
+                payload = line[nd:]
+            if self.ack:
+                self._sendack(mid)
+            else:
+                self.unacked.append(mid)
+            if not mid:  # Server has restarted its message ID's
+                self._seen.clear()
+            if mid not in self._seen:
+                self._seen.add(mid)
+                self.rxq.put_nowait(payload)
+
+    def _sendack(self, mid):
+        if self.opts & OPT_BINARY:
+            self._w.write(frame(FT_ACK, mid))
+        else:
+            self._w.write('{:0{}x}\n'.format(mid, self._nd).encode())
+
+    # Acknowledge messages held unacknowledged and those received from now on.
+    def ackall(self):
+        self.ack = True
+        for mid in self.unacked:
+            self._sendack(mid)
+        self.unacked = []
+
+    # Send a message and return its ID. A retransmission passes the original ID.
+    def send(self, payload, mid=None, typ=FT_MSG):
+        if mid is None:
+            self._mid += 1
+            mid = self._mid
+        if self.opts & OPT_BINARY:
+            self._w.write(frame(typ, mid, payload))
+        else:
+            self._w.write('{:0{}x}'.format(mid, self._nd).encode() + payload + b'\n')
+        return mid
+
+    async def get(self, n=1):  # Return the next n messages
+        return [await asyncio.wait_for(self.rxq.get(), 2) for _ in range(n)]
+
+
+# Connect a simulated client and return it with its Connection once the server
+# is able to send to it.
+async def _connect(cid, opts=0):
+    peer = await Peer(cid, opts).start()
+    conn = await server.client_conn(cid)
+    await asyncio.sleep(0.3)
+    return peer, conn
+
+
+# No more than window qos messages await an ACK. The rest are sent in order as
+# ACKs arrive.
+async def window(opts=0):
+    peer, conn = await _connect('a', opts)
+    win = server.Connection._window
+    peer.ack = False
+    writes = [asyncio.create_task(conn.write('m{}'.format(i))) for i in range(win + 10)]
+    await asyncio.sleep(0.3)
+    assert len(peer.unacked) == win and peer.rxq.qsize() == win
+    assert not any(w.done() for w in writes)
+    peer.ackall()
+    assert await peer.get(win + 10) == [b'm%d' % i for i in range(win + 10)]
+    assert all(await asyncio.gather(*writes))
+    peer.close()
+
+
+# Once rxmax messages are buffered RX_PAUSE leaves further messages
+# unacknowledged for the client to retransmit. RX_OLDEST discards the oldest
+# buffered message and RX_LATEST the new one. ACKs are processed throughout.
+async def rxpolicy():
+    peer, conn = await _connect('a')
+    policy = server.Connection._rxpolicy
+    mids = [peer.send(b'm%d' % (i + 1)) for i in range(5)]
+    write = asyncio.create_task(conn.write('out'))
+    await asyncio.sleep(0.2)
+    assert write.done() and write.result()
+    if policy == server.RX_PAUSE:
+        assert peer.acks == set(mids[:3])
+        assert [await conn.read_bytes() for _ in range(3)] == [b'm1', b'm2', b'm3']
+        for mid in mids[3:]:  # Retransmit
+            peer.send(b'm%d' % mid, mid)
+        await asyncio.sleep(0.2)
+        assert [await conn.read_bytes() for _ in range(2)] == [b'm4', b'm5']
+        assert peer.acks == set(mids)
+    else:
+        assert peer.acks == set(mids)
+        res = [await conn.read_bytes() for _ in range(3)]
+        if policy == server.RX_OLDEST:
+            assert res == [b'm3', b'm4', b'm5']
+        else:
+            assert res == [b'm1', b'm2', b'm3']
+    assert conn._nextmsg() is None
+    peer.close()
+
+
+# on_connect and on_disconnect receive the Connection. A callback which raises
+# does not stop the timer wheel: later outages are still detected.
+_events = []
+
+
+async def _up(conn):
+    _events.append(('up', conn._cl_id))
+
+
+def _down(conn):
+    _events.append(('down', conn._cl_id))
+    raise RuntimeError('deliberate test failure')  # Printed by the server
+
+
+async def callbacks():
+    _events.clear()
+    a, ca = await _connect('a')
+    b, cb = await _connect('b')
+    a.silence()
+    await asyncio.sleep(1.6)
+    assert not ca() and cb()
+    b.silence()
+    await asyncio.sleep(1.6)
+    assert not cb()
+    assert _events == [('up', 'a'), ('up', 'b'), ('down', 'a'), ('down', 'b')]
+    a.close()
+    b.close()
+
+
+# forward_to relays messages to another client's send queue. A message is
+# ACKed once queued: not while the destination is unknown and never if its
+# link can't carry the message. Duplicates are relayed once.
+async def relay():
+    a, ca = await _connect('a', OPT_BINARY)
+    ca.forward_to('b')
+    early = a.send(b'early')
+    await asyncio.sleep(0.2)
+    assert not a.acks  # b is unknown
+    b, cb = await _connect('b')
+    a.send(b'early', early)  # Retransmit
+    newline = a.send(b'ab\ncd')  # Can't be sent as a line of text
+    dupe = a.send(b'x')
+    a.send(b'x', dupe)
+    assert await b.get(2) == [b'early', b'x']
+    await asyncio.sleep(0.2)
+    assert b.rxq.empty() and a.acks == {early, dupe}
+    ca.forward_to(None)
+    a.send(b'local')
+    assert await ca.read_bytes() == b'local'
+    a.close()
+    b.close()
+
+
+# Broker requests are FT_BRK frames or lines starting with a tab. Subscribers
+# receive '<topic>\t<payload>'. Other messages, whatever they contain, and
+# invalid requests are received by readline.
+async def broker():
+    pub, cpub = await _connect('pub', OPT_BINARY)
+    txt, ctxt = await _connect('txt')
+    bin_, _ = await _connect('bin', OPT_BINARY)
+    txt.send(b'\t+home/#')
+    bin_.send(b'+home/temp', typ=FT_BRK)
+    server.subscribe('pub', 'cmd')
+    await asyncio.sleep(0.2)
+    assert server.subscribers('home/temp') == {'txt', 'bin'}
+    pub.send(b'>home/temp\t\x01\t', typ=FT_BRK)
+    pub.send(b'>home/hum\t40', typ=FT_BRK)
+    assert await txt.get(2) == [b'home/temp\t\x01\t', b'home/hum\t40']
+    assert await bin_.get() == [b'home/temp\t\x01\t']
+    msgs = [b'top\xff\tdata', b'\t+x', b'hello']
+    for msg in msgs:
+        pub.send(msg)
+    pub.send(b'>t\xff\tz', typ=FT_BRK)  # Topic is not UTF-8
+    assert [await cpub.read_bytes() for _ in range(4)] == msgs + [b'>t\xff\tz']
+    txt.send(b'-5.3')
+    txt.send(b'+7')
+    txt.send(b'\t?x')  # Unknown request
+    assert [await ctxt.readline() for _ in range(3)] == ['-5.3\n', '+7\n', '\t?x\n']
+    assert await server.publish('cmd', 'on') == {'pub': True}
+    assert await pub.get() == [b'cmd\ton']
+    txt.send(b'\t-home/#')
+    await asyncio.sleep(0.2)
+    assert server.subscribers('home/hum') == set()
+    assert bin_.rxq.empty() and txt.rxq.empty()
+    for peer in (pub, txt, bin_):
+        peer.close()
+
+
+# A keyed write replaces an unsent or unacknowledged message with the same
+# key. The superseded write returns False at once.
+async def conflation():
+    peer, conn = await _connect('a')
+    peer.ack = False
+    first = asyncio.create_task(conn.write('first'))  # Fills the window
+    await asyncio.sleep(0.1)
+    writes = [asyncio.create_task(conn.write('v{}'.format(i), key='k')) for i in range(3)]
+    await asyncio.sleep(0.1)
+    assert [w.done() for w in writes] == [True, True, False]
+    assert not writes[0].result() and not writes[1].result()
+    assert conn.try_write('w0', key='t') and conn.try_write('w1', key='t')
+    peer.ackall()
+    assert await peer.get(3) == [b'first', b'v2', b'w1']
+    assert await first
+    assert await writes[2]
+    peer.ack = False  # Supersede a message which awaits its ACK
+    old = asyncio.create_task(conn.write('old', key='k'))
+    assert await peer.get() == [b'old']
+    new = asyncio.create_task(conn.write('new', key='k'))
+    await asyncio.sleep(0.1)
+    assert old.done() and not old.result()
+    peer.ackall()
+    assert await peer.get() == [b'new']
+    assert await new
+    assert conn.lanes[0].depth == 0 and not conn._keys
+    peer.close()
+
+
+# Wait for the server to detect that a closed peer has gone.
+async def _outage(peer, conn):
+    peer.close()
+    while conn():
+        await asyncio.sleep(0.05)
+
+
+# Messages queued during an outage are sent on reconnection with PRI_HIGH
+# messages ahead of the rest, each lane in order of writing.
+async def priority():
+    peer, conn = await _connect('a')
+    await _outage(peer, conn)
+    writes = [asyncio.create_task(conn.write(s)) for s in ('n1', 'n2')]
+    writes += [asyncio.create_task(conn.write(s, pri=PRI_HIGH)) for s in ('h1', 'h2')]
+    await asyncio.sleep(0.1)
+    assert conn.lanes[PRI_NORMAL].depth == 2 and conn.lanes[PRI_HIGH].depth == 2
+    peer = await Peer('a').start()
+    assert await peer.get(4) == [b'h1', b'h2', b'n1', b'n2']
+    assert all(await asyncio.gather(*writes))
+    for lane in conn.lanes:
+        assert lane.depth == 0 and lane.count == 2
+    peer.close()
+
+
+# A message whose ttl expires during an outage is discarded and its writer
+# returns False. Others are delivered on reconnection.
+async def ttl():
+    peer, conn = await _connect('a')
+    await _outage(peer, conn)
+    keep = asyncio.create_task(conn.write('keep'))
+    assert not await asyncio.wait_for(conn.write('lose', ttl=300), 1)
+    lane = conn.lanes[PRI_NORMAL]
+    assert lane.expired == 1 and lane.depth == 1
+    peer = await Peer('a').start()
+    assert await peer.get() == [b'keep']
+    assert await keep
+    await asyncio.sleep(0.3)
+    assert peer.rxq.empty() and lane.depth == 0
+    peer.close()
+
+
+# A client which reconnects with different options receives the messages which
+# were pending in the new framing. Those the new link cannot carry are
+# discarded and their writers return False.
+async def reframe():
+    peer, conn = await _connect('a')
+    peer.ack = False
+    sent = asyncio.create_task(conn.write('sent'))
+    assert await peer.get() == [b'sent']
+    await _outage(peer, conn)
+    queued = asyncio.create_task(conn.write('queued'))
+    peer = await Peer('a', OPT_BINARY | OPT_MID16).start()
+    assert await peer.get(2) == [b'sent', b'queued']
+    assert await sent and await queued
+    await _outage(peer, conn)
+    lost = asyncio.create_task(conn.write_bytes(b'a\nb'))
+    kept = asyncio.create_task(conn.write_bytes(b'c'))
+    await asyncio.sleep(0.1)
+    peer = await Peer('a').start()
+    assert await peer.get() == [b'c']
+    assert not await lost
+    assert await kept and conn.lanes[PRI_NORMAL].depth == 0
+    peer.close()
+
+
+# Name: (test, args of test, args of server.run)
+TESTS = {
+    'window': (window, (), {'window': 4}),
+    'window16': (window, (OPT_BINARY | OPT_MID16,), {'window': 100}),
+    'rx_pause': (rxpolicy, (), {'rxmax': 3, 'rxpolicy': server.RX_PAUSE}),
+    'rx_oldest': (rxpolicy, (), {'rxmax': 3, 'rxpolicy': server.RX_OLDEST}),
+    'rx_latest': (rxpolicy, (), {'rxmax': 3, 'rxpolicy': server.RX_LATEST}),
+    'callbacks': (callbacks, (), {'on_connect': _up, 'on_disconnect': _down}),
+    'relay': (relay, (), {}),
+    'broker': (broker, (), {'broker': True}),
+    'conflation': (conflation, (), {}),
+    'priority': (priority, (), {}),
+    'ttl': (ttl, (), {}),
+    'reframe': (reframe, (), {}),
+}
+
+
+def _reset():
+    Connection = server.Connection
+    Connection.close_all()
+    Connection._conns.clear()
+    Connection._evconn.clear()
+    Connection._topics.clear()
+    Connection._rtq.clear()
+    Connection._server_sock = None
+    for slot in Connection._wheel:
+        slot.clear()
+
+
+def main(names):
+    for name in names or TESTS:
+        test, args, kwargs = TESTS[name]
+
+        async def run():
+            asyncio.create_task(server.run(None, port=PORT, timeout=TIMEOUT, **kwargs))
+            await asyncio.sleep(0.1)
+            try:
+                await test(*args)
+            finally:
+                _reset()
+
+        asyncio.run(run())
+        print(name, 'OK')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,7 +15,11 @@
 # Under CPython requires CPython 3.8 or later.
 
 import sys
-from . import gmid, isnew  # __init__.py
+from . import gmid, isnew, MidWindow, idopts, ackfmt, ackids  # __init__.py
+from . import frame, ackframe, frameacks, struct, HDR, HDR_LEN, FT_MSG, FT_ACK, FT_KA
+from . import FT_BRK
+from . import OPT_ACKBATCH, OPT_BINARY, OPT_MID16, WINDOW, WINDOW16, Rtt
+from . import PRI_NORMAL, PRI_HIGH, Lane
 
 upython = sys.implementation.name == 'micropython'
 if upython:
@@ -24,16 +28,31 @@ if upython:
     import utime as time
     import uselect as select
     import uerrno as errno
+    from ucollections import deque
 else:
     import socket
     import asyncio
     import time
     import select
     import errno
-
-Lock = asyncio.Lock
+    from collections import deque
 
 TIM_TINY = 0.05  # Short delay avoids 100% CPU utilisation in busy-wait loops
+if upython:  # Millisecond timing
+    _ms = time.ticks_ms
+    _tdiff = time.ticks_diff
+else:
+    def _ms():
+        return int(time.monotonic() * 1000)
+
+    def _tdiff(a, b):
+        return a - b
+# Behaviour when a Connection's inbound buffer is full (run rxpolicy arg)
+RX_PAUSE = 0  # Don't ACK the message: the client retransmits it later
+RX_OLDEST = 1  # Discard the oldest buffered message
+RX_LATEST = 2  # Discard the message just received
+_NSLOTS = 8  # Timer wheel slots
+_KA_FRAME = frame(FT_KA)  # OPT_BINARY keepalive
 
 # Read the node ID. There isn't yet a Connection instance.
 # CPython does not have socket.readline. Return 1st string received
@@ -46,7 +65,15 @@ async def _readid(s, to_secs):
     start = time.time()
     while True:
         try:
-            d = s.recv(4096).decode()
+            if upython:
+                d = s.recv(4096).decode()
+            else:  # CPython: pause until data arrives
+                tim = to_secs - (time.time() - start)
+                d = await asyncio.wait_for(
+                    asyncio.get_running_loop().sock_recv(s, 4096), tim)
+                d = d.decode()
+        except asyncio.TimeoutError:
+            raise OSError  # Timeout waiting for data
         except OSError as e:
             err = e.args[0]
             if err == errno.EAGAIN:
@@ -65,70 +92,254 @@ async def _readid(s, to_secs):
                 return data
 
 
+# Limit the number of concurrent client handshakes. uasyncio V3 has no
+# Semaphore. Only the accept loop acquires so a single Event suffices.
+class _Slots:
+    def __init__(self, n):
+        self._n = n
+        self._ev = asyncio.Event()
+
+    async def acquire(self):
+        while not self._n:
+            await self._ev.wait()  # Pause until a handshake completes
+            self._ev.clear()
+        self._n -= 1
+
+    def release(self):
+        self._n += 1
+        self._ev.set()
+
+
+# Each handshake runs as a separate task: a client which is slow to send its ID
+# occupies one slot rather than delaying all other accepts.
+async def _handshake(slots, c_sock, to_secs, verbose):
+    try:
+        data = await _readid(c_sock, to_secs)
+        Connection.go(to_secs, data, verbose, c_sock)
+    except (OSError, ValueError):  # Timeout or malformed ID. A UnicodeError
+        verbose and print('Client handshake failed.')  # is a ValueError.
+        c_sock.close()
+    finally:
+        slots.release()
+
+
+# Run a callback or launch a coroutine. Callbacks run in the I/O path, often in
+# the timer wheel task, so an exception is reported rather than propagated.
+def _launch(func, *args):
+    try:
+        res = func(*args)
+    except Exception as e:
+        print('Callback {} failed: {!r}'.format(func, e))
+        return
+    if hasattr(res, 'send'):
+        asyncio.create_task(res)
+
+
+# Server-wide timer wheel. Each Connection occupies one slot and one slot is
+# serviced per tick, so every Connection is visited once per keepalive period
+# with the work spread evenly over the period. Connections with unacknowledged
+# messages are also checked for retransmission on every tick. A failure of one
+# Connection is reported and does not stop the wheel.
+async def _timers(tim_ka):
+    wheel = Connection._wheel
+    rtq = Connection._rtq
+    tick = tim_ka / _NSLOTS
+    n = 0
+    while True:
+        await asyncio.sleep(tick)
+        for conn in wheel[n]:
+            try:
+                conn._timer()
+            except Exception as e:
+                print('Timer failed for {}: {!r}'.format(conn._cl_id, e))
+        n = (n + 1) % _NSLOTS
+        if rtq:
+            t = _ms()
+            for conn in list(rtq):
+                try:
+                    if not conn._retx(t):  # Nothing awaiting an ACK
+                        rtq.discard(conn)
+                except Exception as e:
+                    print('Retransmit failed for {}: {!r}'.format(conn._cl_id, e))
+
+
 # API: application calls server.run()
-# Allow 2 extra connections. This is to cater for error conditions like
-# duplicate or unexpected clients. Accept the connection and have the
+# By default allow 2 extra connections. This is to cater for error conditions
+# like duplicate or unexpected clients. Accept the connection and have the
 # Connection class produce a meaningful error message.
-async def run(expected, verbose=False, port=8123, timeout=2000):
+# If expected is None any client may connect: there is no up-front registry.
+async def run(expected=None, verbose=False, port=8123, timeout=2000,
+              handshakes=20, window=1, flush_ms=0, qmax=100, qlow=50,
+              rxmax=100, rxpolicy=RX_PAUSE, backlog=None,
+              on_connect=None, on_disconnect=None, broker=False):
+    if not 0 < window <= WINDOW16:
+        raise ValueError('window must be in range 1-{}'.format(WINDOW16))
+    if not 0 <= qlow < qmax:
+        raise ValueError('qlow must be less than qmax')
+    Connection._window = window
+    Connection._to_ms = timeout
+    Connection._qmax = qmax
+    Connection._qlow = qlow
+    Connection._rxmax = rxmax
+    Connection._rxpolicy = rxpolicy
+    Connection._flush_s = flush_ms / 1000
+    Connection._on_connect = on_connect
+    Connection._on_disconnect = on_disconnect
+    Connection._broker = broker
+    Connection._expected = None if expected is None else set(expected)
     addr = socket.getaddrinfo('0.0.0.0', port, 0, socket.SOCK_STREAM)[0][-1]
     s_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # server socket
     s_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s_sock.bind(addr)
-    s_sock.listen(len(expected) + 2)
+    if backlog is None:
+        backlog = 128 if expected is None else len(expected) + 2
+    s_sock.listen(backlog)
+    Connection._server_sock = s_sock
     verbose and print('Awaiting connection.', port)
-    poller = select.poll()
-    poller.register(s_sock, select.POLLIN)
     to_secs = timeout / 1000  # ms -> secs
+    if upython:
+        poller = select.poll()
+        poller.register(s_sock, select.POLLIN)
+    else:  # CPython: accept via the event loop rather than by polling
+        s_sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+    asyncio.create_task(_timers(to_secs / 4))  # Keepalive interval
+    slots = _Slots(handshakes)
     while True:
-        res = poller.poll(1)  # 1ms block
-        if res:  # Only s_sock is polled
+        await slots.acquire()  # Pause if too many handshakes are in progress
+        if upython:
+            res = poller.poll(1)  # 1ms block
+            if not res:  # Only s_sock is polled
+                slots.release()
+                await asyncio.sleep(0.2)
+                continue
             c_sock, _ = s_sock.accept()  # get client socket
-            c_sock.setblocking(False)
-            try:
-                data = await _readid(c_sock, to_secs)
-            except OSError:
-                c_sock.close()
-            else:
-                Connection.go(to_secs, data, verbose, c_sock, s_sock,
-                              expected)
-        await asyncio.sleep(0.2)
+        else:  # Wakes as soon as a client connects. No rate limit.
+            c_sock, _ = await loop.sock_accept(s_sock)
+        c_sock.setblocking(False)
+        asyncio.create_task(_handshake(slots, c_sock, to_secs, verbose))
+        if upython:
+            await asyncio.sleep(0.2)
+
+
+# Encode a line of text as a message payload. Text payloads end in newline.
+# Binary frames carry the length so the newline is not sent.
+def _encode(line, binary):
+    if binary:
+        return (line[:-1] if line.endswith('\n') else line).encode()
+    return (line if line.endswith('\n') else line + '\n').encode()
+
+
+# Broadcast: counts outstanding ACKs and sets an Event when none remain.
+class _Gather:
+    def __init__(self, n):
+        self.n = n
+        self.ev = asyncio.Event()
+
+    def done(self):
+        self.n -= 1
+        if not self.n:
+            self.ev.set()
+
+
+# Broadcast: stands in for the Event of one recipient's _Pend.
+class _Ack:
+    __slots__ = ('_g', 'ok')
+
+    def __init__(self, g):
+        self._g = g
+        self.ok = False
+
+    def set(self):
+        if not self.ok:
+            self.ok = True
+            self._g.done()
+
+
+# A message in the send queue and, if qos, awaiting its ACK.
+class _Pend:
+    __slots__ = ('line', 'qos', 'win', 'ev', 'key', 'pri', 'ttl', 'mid', 'tq',
+                 't', 'n')
+
+    def __init__(self, buf, qos, win, ev, key=None, pri=PRI_NORMAL, ttl=0):
+        self.line = buf  # Payload. Once sent, as sent for retransmission. None
+        # if discarded.
+        self.qos = qos
+        self.win = win  # Subject to the send window
+        self.ev = ev  # Set when ACK received (None if nobody waits)
+        self.key = key  # Conflation key
+        self.pri = pri  # Priority lane
+        self.ttl = ttl  # Time to live (ms). 0: no limit
+        self.mid = None  # Message ID once sent
+        self.tq = _ms()  # Time written (ms)
+        self.t = 0  # Time of last transmission (ms)
+        self.n = 0  # No. of retransmissions
+
+    def expired(self, t):
+        return self.ttl and _tdiff(t, self.tq) >= self.ttl
 
 
 # A Connection persists even if client dies (minimise object creation).
 # If client dies Connection is closed: ._close() flags this state by closing its
 # socket and setting .sock to None (.status() == False).
+# Instances are slotted to minimise RAM use with large numbers of clients.
 class Connection:
+    __slots__ = ('_to_secs', '_sock', '_cl_id', '_verbose', 'rtt', 'nconns',
+                 '_rxidle', '_txd', '_opts', '_getmid', '_isnew', '_win',
+                 '_mfmt', '_nd', '_wr_pause', '_await_client', '_obuf', '_txq',
+                 '_nfree', '_qfull', '_evq', '_lines', '_evline', '_acks_pend',
+                 '_ackq', '_ibuf', '_tact', '_loop', '_flush_h', '_wrwait',
+                 '_fwd', '_keys', '_nhi', 'lanes', '_nttl')
     _conns = {}  # index: client_id. value: Connection instance
-    _expected = set()  # Expected client_id's
+    _expected = set()  # Expected client_id's. None: any client may connect.
     _server_sock = None
+    _evconn = {}  # index: client_id. value: Event set when client connects
+    _evall = None  # Event set when all expected clients have connected
+    _on_connect = None  # Callbacks (set by run)
+    _on_disconnect = None
+    _window = 1  # Max no. of unacknowledged qos messages (set by run)
+    _to_ms = 2000  # Link timeout (set by run)
+    _flush_s = 0  # Max delay before queued data is sent (set by run)
+    _qmax = 100  # Send queue high watermark (set by run)
+    _qlow = 50  # Send queue low watermark (set by run)
+    _rxmax = 100  # Inbound buffer limit (set by run)
+    _rxpolicy = RX_PAUSE  # Action when inbound buffer is full (set by run)
+    _wheel = [[] for _ in range(_NSLOTS)]  # Timer wheel slots
+    _rtq = set()  # Connections with messages awaiting ACK
+    _broker = False  # Route messages by topic (set by run)
+    _topics = {}  # index: topic. value: set of subscribed client_id's
 
     @classmethod
-    def go(cls, to_secs, data, verbose, c_sock, s_sock, expected):
+    def go(cls, to_secs, data, verbose, c_sock):
         client_id, init_str = data.split('\n', 1)
+        client_id, opts = idopts(client_id)
         verbose and print('Got connection from client', client_id)
-        if cls._server_sock is None:  # 1st invocation
-            cls._server_sock = s_sock
-            cls._expected.update(expected)
         if client_id in cls._conns:  # Old client, new socket
             if cls._conns[client_id].status():
                 print('Duplicate client {} ignored.'.format(client_id))
                 c_sock.close()
             else:  # Reconnect after failure
-                cls._conns[client_id]._reconnect(c_sock)
+                cls._conns[client_id]._reconnect(c_sock, init_str, opts)
         else: # New client: instantiate Connection
-            Connection(to_secs, c_sock, client_id, init_str, verbose)
+            Connection(to_secs, c_sock, client_id, init_str, verbose, opts)
+
+    # Pause until a given client next connects.
+    @classmethod
+    async def _await_conn(cls, client_id):
+        ev = cls._evconn.get(client_id)
+        if ev is None:
+            ev = asyncio.Event()
+            cls._evconn[client_id] = ev
+        await ev.wait()
 
     # Server-side app waits for a working connection
     @classmethod
     async def client_conn(cls, client_id):
         while True:
-            if client_id in cls._conns:
-                c = cls._conns[client_id]
-                # await c 
-                # works but under CPython produces runtime warnings. So do:
-                await c._status_coro()
+            c = cls._conns.get(client_id)
+            if c is not None and c():
                 return c
-            await asyncio.sleep(0.5)
+            await cls._await_conn(client_id)
 
     # App waits for all expected clients to connect.
     @classmethod
@@ -136,14 +347,111 @@ class Connection:
         conn = None
         if client_id is not None:
             conn = await client_conn(client_id)
-        if peers is None:  # Wait for all expected clients
-            while cls._expected:
-                await asyncio.sleep(0.5)
+        if peers is None:  # Wait for all expected clients (if any)
+            if cls._expected:
+                if cls._evall is None:
+                    cls._evall = asyncio.Event()
+                await cls._evall.wait()
         else:
-            while not set(cls._conns.keys()).issuperset(peers):
-                await asyncio.sleep(0.5)
+            for client_id in peers:
+                while client_id not in cls._conns:
+                    await cls._await_conn(client_id)
         return conn
 
+    # Send a line to each client in clients (default all known clients). The
+    # payload is encoded once and shared by every Connection. Each message is
+    # queued without pausing. With qos pause until all are acknowledged or
+    # timeout (ms, default the link timeout) elapses. Return a dict of client_id: True if acknowledged
+    # (qos) or queued (not qos). False if unknown, if the send queue is full or
+    # if no ACK arrived in time. Unacknowledged qos messages remain queued.
+    @classmethod
+    async def broadcast(cls, line, clients=None, qos=True, timeout=None,
+                        pri=PRI_NORMAL):
+        conns = cls._conns
+        res = {}
+        acks = []
+        payload = [None, None]  # Text, binary
+        g = _Gather(0)
+        for client_id in (list(conns) if clients is None else clients):
+            c = conns.get(client_id)
+            if c is None or c._full():
+                res[client_id] = False
+                continue
+            binary = 1 if c._opts & OPT_BINARY else 0
+            if payload[binary] is None:
+                payload[binary] = c._chklen(_encode(line, binary))
+            ack = None
+            if qos:
+                ack = _Ack(g)
+                acks.append((client_id, ack))
+                g.n += 1
+            c._put(_Pend(payload[binary], qos, qos, ack, None, pri))
+            res[client_id] = True
+        if acks:
+            if timeout is None:
+                timeout = cls._to_ms
+            try:
+                await asyncio.wait_for(g.ev.wait(), timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+            for client_id, ack in acks:
+                res[client_id] = ack.ok
+        return res
+
+    # Topic broker. A topic is a string whose levels are separated by '/'. A
+    # subscription to 'a/#' matches 'a/b' and 'a/b/c', '#' matches any topic.
+    # Subscriptions persist if the client reconnects.
+    @classmethod
+    def subscribe(cls, client_id, topic):
+        subs = cls._topics.get(topic)
+        if subs is None:
+            subs = set()
+            cls._topics[topic] = subs
+        subs.add(client_id)
+
+    @classmethod
+    def unsubscribe(cls, client_id, topic):
+        subs = cls._topics.get(topic)
+        if subs is not None:
+            subs.discard(client_id)
+            if not subs:
+                del cls._topics[topic]
+
+    # Return the ID's of clients subscribed to a topic. Each level of the
+    # topic costs one dict lookup however many subscriptions exist.
+    @classmethod
+    def subscribers(cls, topic):
+        topics = cls._topics
+        res = set(topics.get(topic, ()))
+        n = len(topic)
+        while n >= 0:
+            n = topic.rfind('/', 0, n)
+            subs = topics.get(topic[:n + 1] + '#')
+            if subs:
+                res.update(subs)
+        return res
+
+    # Publish a line to the subscribers to a topic. Subscribers receive
+    # '<topic>\t<line>'. Args and return value as per broadcast.
+    @classmethod
+    async def publish(cls, topic, line, qos=True, timeout=None, pri=PRI_NORMAL):
+        return await cls.broadcast('{}\t{}'.format(topic, line),
+                                   cls.subscribers(topic), qos, timeout, pri)
+
+    # A message published by a client is passed on as '<topic>\t<payload>'. It
+    # is dropped for subscribers whose send queue is full.
+    @classmethod
+    def _publish(cls, topic, msg, binary):
+        conns = cls._conns
+        for client_id in cls.subscribers(topic):
+            c = conns.get(client_id)
+            if c is None:
+                continue
+            if c._full():
+                c._verbose and print('Drop', topic, 'to', client_id)
+            elif c._fits(msg, binary):
+                c._forward(msg, binary, True)
+
     @classmethod
     def close_all(cls):
         for conn in cls._conns.values():
@@ -151,44 +459,197 @@ class Connection:
         if cls._server_sock is not None:
             cls._server_sock.close()
 
-    def __init__(self, to_secs, c_sock, client_id, init_str, verbose):
+    def __init__(self, to_secs, c_sock, client_id, init_str, verbose, opts):
         self._to_secs = to_secs
-        self._tim_short = self._to_secs / 10
-        self._tim_short_ms = int(self._to_secs * 100)  # MicroPython only!
-        self._tim_ka = self._to_secs / 4  # Keepalive interval
         self._sock = c_sock  # Socket
         self._cl_id = client_id
         self._verbose = verbose
-        self._newlist = bytearray(32)  # Per-client de-dupe list
         self.nconns = 0  # Reconnect count (information only)
+        self.rtt = Rtt(int(to_secs * 1000))  # Round trip time statistics
+        self._rxidle = 0  # Timer wheel visits since data was received
+        self._txd = False  # Data sent since last timer wheel visit
+        Connection._wheel[len(Connection._conns) % _NSLOTS].append(self)
         Connection._conns[client_id] = self
-        try:
-            Connection._expected.remove(client_id)
-        except KeyError:
-            print('Unknown client {} has connected. Expected {}.'.format(
-                client_id, Connection._expected))
+        if Connection._expected is not None:
+            try:
+                Connection._expected.remove(client_id)
+            except KeyError:
+                print('Unknown client {} has connected. Expected {}.'.format(
+                    client_id, Connection._expected))
+            else:
+                if not Connection._expected and Connection._evall is not None:
+                    Connection._evall.set()  # Wake wait_all
 
-        self._getmid = gmid()  # Message ID generator
+        self._setopts(opts)
         # ._wr_pause set after initial or subsequent client connection. Cleared
         # after 1st keepalive received. We delay sending anything other than
         # keepalives while ._wr_pause is set
         self._wr_pause = True
         self._await_client = True  # Waiting for 1st received line.
-        self._wlock = Lock()  # Write lock
-        self._lines = []  # Buffer of received lines
-        self._acks_pend = set()  # ACKs which are expected to be received
-        asyncio.create_task(self._read(init_str))
-        asyncio.create_task(self._keepalive())
+        self._obuf = bytearray()  # Data awaiting transmission
+        # Messages awaiting transmission. Held during an outage or while the
+        # window is full. ._nfree counts those not subject to the window.
+        # PRI_HIGH messages precede the rest: ._nhi counts them.
+        self._txq = []
+        self._nfree = 0
+        self._nhi = 0
+        self.lanes = (Lane(), Lane())  # Statistics: index is priority
+        self._nttl = 0  # No. of unsent or unacknowledged messages with a ttl
+        self._qfull = False  # Set at high watermark, cleared at low
+        self._evq = None  # Set when ._qfull is cleared. Created when needed.
+        # Buffer of received lines. ._rxed never exceeds the limit.
+        self._lines = deque((), Connection._rxmax)
+        self._fwd = None  # Relay mode: (client_id, qos)
+        self._keys = {}  # Conflation. index: key. value: unsent or unacked _Pend
+        self._evline = asyncio.Event()  # Set when lines are received
+        # ACKs which are expected to be received. index: message ID. value:
+        # _Pend instance. Ordered by transmission.
+        self._acks_pend = {}
+        self._ackq = []  # OPT_ACKBATCH: ID's of messages awaiting our ACK
+        self._ibuf = bytearray()  # Partial line or frame received
+        self._flush_h = None  # Flush scheduled
+        if upython:
+            self._tact = None  # Time at which to end ._wr_pause
+            asyncio.create_task(self._io(init_str))
+        else:
+            self._loop = asyncio.get_running_loop()
+            self._wrwait = False  # Awaiting socket writeable
+            self._attach(c_sock, init_str)
+        self._connected()
 
-    def _reconnect(self, c_sock):
-        self._sock = c_sock
+    # Configure message ID handling for options requested by client.
+    def _setopts(self, opts):
+        self._opts = opts  # Link options requested by client
+        if opts & OPT_MID16:
+            self._getmid = gmid(0xffff)  # Message ID generator
+            self._isnew = MidWindow()  # Per-client de-dupe
+            self._win = Connection._window  # Send window
+            self._mfmt = '{:04x}'  # Message ID format (text mode)
+        else:
+            self._getmid = gmid()
+            newlist = bytearray(32)
+            self._isnew = lambda mid: isnew(mid, newlist)
+            self._win = min(Connection._window, WINDOW)
+            self._mfmt = '{:02x}'
+        self._nd = len(self._mfmt.format(0))  # No. of hex digits in ID
+
+    def _reconnect(self, c_sock, init_str, opts):
+        if opts != self._opts:  # Client has been reconfigured
+            self._reframe(opts)
+            self._setopts(opts)
         self._wr_pause = True
         self._await_client = True
+        if upython:
+            self._sock = c_sock
+        else:
+            self._attach(c_sock, init_str)
+        self._connected()
+
+    # Before a change of link options. Messages awaiting an ACK were framed with
+    # the old message ID: they return to the front of their lane in the send
+    # queue, in order of transmission, to be sent again with new ID's. Queued
+    # payloads are adjusted for the new framing. One which can't be carried is
+    # discarded: its writer returns False.
+    def _reframe(self, opts):
+        old = self._opts
+        hi = []
+        lo = []
+        for pend in self._acks_pend.values():
+            pend.line = pend.line[HDR_LEN if old & OPT_BINARY else self._nd:]
+            pend.mid = None
+            (hi if pend.pri else lo).append(pend)
+            self._nfree += not pend.win
+        self._acks_pend = {}
+        q = self._txq
+        nhi = self._nhi
+        q = hi + q[:nhi] + lo + q[nhi:]
+        self._nhi = nhi + len(hi)
+        self._txq = q
+        if (old ^ opts) & OPT_BINARY:
+            binary = opts & OPT_BINARY
+            i = 0
+            while i < len(q):
+                pend = q[i]
+                line = pend.line
+                if binary:
+                    line = line[:-1]
+                    ok = len(line) <= 0xffff
+                else:
+                    ok = b'\n' not in line
+                    line += b'\n'
+                if ok:
+                    pend.line = line
+                    i += 1
+                else:
+                    self._verbose and print('Message not sent to', self._cl_id,
+                                            'after change of framing.')
+                    self._unqueue(i)
+                    self._unkey(pend)
+                    self._discard(pend)
+        if len(q) >= self._qmax:
+            self._qfull = True
+        self._chkq()
+
+    # A socket has been (re)attached: wake tasks awaiting the client.
+    def _connected(self):
+        ev = Connection._evconn.pop(self._cl_id, None)
+        if ev is not None:
+            ev.set()
+        if Connection._on_connect is not None:
+            _launch(Connection._on_connect, self)
+
+    # CPython: reading is driven by socket readiness. The event loop calls
+    # ._readable when data is available so idle connections cost nothing.
+    def _attach(self, c_sock, init_str):
+        self._sock = c_sock
+        self._ibuf = bytearray()  # Discard partial data from previous socket
+        self.nconns += 1
+        self._rxidle = 0
+        self._loop.add_reader(c_sock, self._readable)
+        if init_str:
+            self._got(init_str.encode())
 
-    # Have received 1st data packet from client. Launched by ._read
-    async def _client_active(self):
-        await asyncio.sleep(0.2)  # Let ESP get out of bed.
+    def _readable(self):
+        try:
+            d = self._sock.recv(4096)  # bytes object
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:  # Spurious wakeup is harmless
+                self._close('_read reset by peer 104')
+        else:
+            self._rxidle = 0
+            self._got(d)
+
+    # Called by the timer wheel once per keepalive period. Discard expired
+    # messages (even during an outage), detect read timeout and send a
+    # keepalive if nothing else was sent.
+    def _timer(self):
+        self._purge(_ms())
+        if not self():
+            return
+        self._rxidle += 1
+        if self._rxidle > 4:  # Nothing received for a timeout period
+            self._close('_read timeout')
+            return
+        if not self._txd:  # Idle: send a keepalive
+            self._obuf += _KA_FRAME if self._opts & OPT_BINARY else b'\n'
+            self._kick()
+        self._txd = False
+
+    # Have received 1st data packet from client. Called 200ms later to let ESP
+    # get out of bed.
+    def _activate(self):
         self._wr_pause = False
+        if self():
+            # Retransmit any messages unacknowledged at the time of the
+            # outage. Sending in order of transmission preserves message order.
+            t = _ms()
+            self._purge(t)
+            for pend in self._acks_pend.values():
+                pend.t = t
+                pend.n += 1
+                self._obuf += pend.line
+            self._pump()  # Then anything queued during the outage
+            self._kick()
 
     def status(self):
         return self._sock is not None
@@ -197,8 +658,7 @@ class Connection:
 
     def __await__(self):
         if upython:
-            while not self():
-                yield from asyncio.sleep_ms(self._tim_short_ms)
+            yield from self._status_coro()
         else: 
             # CPython: Meet requirement for generator in __await__
             # https://github.com/python/asyncio/issues/451
@@ -208,177 +668,565 @@ class Connection:
 
     async def _status_coro(self):
         while not self():
-            await asyncio.sleep(self._tim_short)
+            await Connection._await_conn(self._cl_id)
 
+    # Received messages are held as payload bytes: in text mode these include
+    # the newline. Decoding is deferred until the app reads.
     async def readline(self):
-        l = self._readline()
-        if l is not None:
-            return l
-        # Must wait for data
+        msg = (await self._readmsg()).decode()
+        return msg if not self._opts & OPT_BINARY else '{}{}'.format(msg, '\n')
+
+    # Return a message as bytes. With OPT_BINARY these are as sent by the
+    # client, otherwise they are the encoded line without a newline.
+    async def read_bytes(self):
+        msg = await self._readmsg()
+        return msg if self._opts & OPT_BINARY else msg[:-1]
+
+    # Relay mode: pass messages from this client to another client's send
+    # queue without decoding them. Messages are no longer returned by
+    # .readline. client_id None ends relay mode.
+    def forward_to(self, client_id, qos=True):
+        self._fwd = None if client_id is None else (client_id, qos)
+
+    async def _readmsg(self):
         while True:
+            msg = self._nextmsg()
+            if msg is not None:
+                return msg
+            # Must wait for data
             if not self():  # Outage
                 self._verbose and print('Client:', self._cl_id, 'awaiting connection')
                 await self._status_coro()
                 self._verbose and print('Client:', self._cl_id, 'connected')
-            while self():
-                l = self._readline()
-                if l is not None:
-                    return l
-                await asyncio.sleep(TIM_TINY)  # Limit CPU utilisation
-
-    # Immediate return. If a non-duplicate line is ready return it.
-    def _readline(self):
-        while self._lines:
-            line = self._lines.pop(0)
+            else:  # ._rxed sets the Event when messages arrive
+                self._evline.clear()
+                await self._evline.wait()
+
+    # Immediate return. If a non-duplicate message is ready return it.
+    def _nextmsg(self):
+        lines = self._lines
+        while lines:
             # Discard dupes: get message ID
-            mid = int(line[0:2], 16)
+            mid, msg = lines.popleft()
             # mid == 0 : client has power cycled. Clear list of mid's.
             if not mid:
-                isnew(-1, self._newlist)
-            if isnew(mid, self._newlist):
-                return '{}{}'.format(line[2:], '\n')
+                self._isnew(-1)
+            if self._isnew(mid):
+                return msg
 
-    async def _read(self, istr):
+    # MicroPython: the Connection's only task. Poll the nonblocking socket and
+    # send data which could not be sent when it was queued.
+    async def _io(self, init_str):
+        if init_str:
+            self._got(init_str.encode())
         while True:
-            # Start (or restart after outage). Do this promptly.
-            # Fast version of await self._status_coro()
-            while self._sock is None:
-                await asyncio.sleep(TIM_TINY)
+            # Start (or restart after outage).
+            await self._status_coro()
             self.nconns += 1  # For test scripts
-            start = time.time()
+            self._rxidle = 0  # The timer wheel detects read timeout
             while self():
+                tact = self._tact
+                if tact is not None and time.ticks_diff(time.ticks_ms(), tact) >= 0:
+                    self._tact = None
+                    self._activate()
+                d = None
                 try:
                     d = self._sock.recv(4096)  # bytes object
-                    #print('TEST', d)
                 except OSError as e:
-                    err = e.args[0]
-                    if err == errno.EAGAIN:  # Would block: try later
-                        if time.time() - start > self._to_secs:
-                            self._close('_read timeout')  # Unless it timed out.
-                        else:
-                            # Waiting for data from client. Limit CPU overhead.
-                            await asyncio.sleep(TIM_TINY)
-                    else:
+                    if e.args[0] != errno.EAGAIN:  # Would block: try later
                         self._close('_read reset by peer 104')
+                        break
                 else:
-                    start = time.time()  # Something was received
-                    if self._await_client:  # 1st item after (re)start
-                        self._await_client = False  # Enable write after delay
-                        asyncio.create_task(self._client_active())
-                    if d == b'':  # Reset by peer
-                        self._close('_read reset by peer')
+                    self._rxidle = 0  # Something was received
+                    self._got(d)
+                if self._obuf or self._ackq:
+                    await asyncio.sleep(self._flush_s)  # Allow data to be queued
+                    self._flush()
+                    if self._obuf:  # Socket is full
+                        await asyncio.sleep(TIM_TINY)
+                elif d is None:
+                    # Waiting for data from client. Limit CPU overhead.
+                    await asyncio.sleep(TIM_TINY)
+
+    # Handle data received from the socket.
+    def _got(self, d):
+        if self._await_client:  # 1st item after (re)start
+            self._await_client = False  # Enable write after delay
+            if upython:
+                self._tact = time.ticks_add(time.ticks_ms(), 200)
+            else:
+                self._loop.call_later(0.2, self._activate)
+        if d == b'':  # Reset by peer
+            self._close('_read reset by peer')
+            return
+        if self._opts & OPT_BINARY:
+            self._process_bin(d)
+        else:
+            self._process_text(d)
+
+    # Extract complete lines from received data in a single pass over the new
+    # data, sorting them into messages and ACKs. Only a partial line at the
+    # end of the data is copied, to be completed by the next call.
+    def _process_text(self, d):
+        end = d.find(b'\n')
+        if end == -1:  # No complete line
+            self._ibuf += d
+            return
+        acks = []
+        msgs = []
+        reqs = []
+        mv = memoryview(d)
+        start = 0
+        buf = self._ibuf
+        if buf:  # Complete the partial line
+            buf += mv[:end + 1]
+            b = bytes(buf)  # MicroPython int() rejects bytearray
+            self._parse(b, memoryview(b), 0, len(b) - 1, acks, msgs, reqs)
+            self._ibuf = bytearray()
+            start = end + 1
+            end = d.find(b'\n', start)
+        while end != -1:
+            self._parse(d, mv, start, end, acks, msgs, reqs)
+            start = end + 1
+            end = d.find(b'\n', start)
+        if start < len(d):
+            self._ibuf += mv[start:]  # Partial line
+        self._rxed(acks, msgs, reqs)
+
+    # Parse the line in b[start:end] where b[end] is its \n. mv is a memoryview
+    # of b, used to extract messages (with their \n) with a single copy. With
+    # the broker a message starting with a tab is a request: the tab is
+    # removed.
+    def _parse(self, b, mv, start, end, acks, msgs, reqs):
+        nd = self._nd
+        n = end - start
+        if n == nd:  # ACK
+            acks.append(int(b[start:end], 16))
+        elif n:  # Empty lines are keepalives
+            if b[start] == 0x2a:  # '*' Batched ACK
+                acks.extend(ackids(str(mv[start + 1:end], 'utf8')))
+            elif Connection._broker and b[start + nd] == 0x09:  # '\t'
+                reqs.append((int(b[start:start + nd], 16),
+                             bytes(mv[start + nd + 1:end + 1])))
+            else:
+                msgs.append((int(b[start:start + nd], 16),
+                             bytes(mv[start + nd:end + 1])))
+
+    # OPT_BINARY: extract complete frames from received data. Retain any
+    # partial frame. Without the broker FT_BRK frames are ordinary messages.
+    def _process_bin(self, d):
+        buf = self._ibuf
+        buf += d
+        acks = []
+        msgs = []
+        reqs = []
+        mv = memoryview(buf)
+        start = 0
+        while len(buf) - start >= HDR_LEN:
+            typ, mid, n = struct.unpack_from(HDR, buf, start)
+            end = start + HDR_LEN + n
+            if end > len(buf):  # Partial frame
+                break
+            if typ == FT_MSG or typ == FT_BRK and not Connection._broker:
+                msgs.append((mid, bytes(mv[start + HDR_LEN:end])))
+            elif typ == FT_BRK:
+                reqs.append((mid, bytes(mv[start + HDR_LEN:end])))
+            elif typ == FT_ACK:
+                acks.extend(frameacks(mid, mv[start + HDR_LEN:end]))
+            start = end  # FT_KA: nothing to do
+        if start:
+            self._ibuf = buf[start:]  # MicroPython has no slice deletion
+        self._rxed(acks, msgs, reqs)
+
+    # Put (message ID, message) pairs into ._lines and remove ACKs from
+    # ._acks_pend, waking their writers. reqs holds broker requests.
+    def _rxed(self, acks, msgs, reqs):
+        if acks:
+            t = _ms()
+            for mid in acks:
+                pend = self._acks_pend.pop(mid, None)
+                if pend is not None:  # qos0 acks are ignored
+                    if not pend.n:  # Only sent once: the RTT is unambiguous
+                        self.rtt.sample(_tdiff(t, pend.t))
+                    self._done(pend, t)
+                    if pend.ev is not None:  # Wake writer
+                        pend.ev.set()
+            self._pump()  # Window may have space
+        if reqs:
+            msgs += self._route(reqs)  # Invalid requests are ordinary messages
+            self._kick()
+        if msgs:
+            if self._fwd is not None:
+                self._relay(msgs)
+                self._kick()
+                return
+            lines = self._lines
+            for msg in msgs:
+                if len(lines) >= self._rxmax:  # Buffer full
+                    policy = self._rxpolicy
+                    if policy == RX_LATEST:
+                        self._ack(msg[0])  # Discard it
                         continue
-                    d = d.lstrip(b'\n')  # Discard leading KA's
-                    if d == b'':  # Only KA's
+                    if policy == RX_OLDEST:
+                        lines.popleft()
+                    else:  # RX_PAUSE: discard it unacknowledged
                         continue
+                lines.append(msg)
+                self._ack(msg[0])
+            self._kick()
+            self._evline.set()  # Wake any task paused in .readline
 
-                    istr += d.decode()  # Add to any partial message
-                    # Strings from this point
-                    l = istr.split('\n')
-                    istr = l.pop()  # '' unless partial line
-                    self._process_str(l)
-
-    # Given a list of received lines remove any ka's from middle. Split into
-    # messages and ACKs. Put messages into ._lines and remove ACKs from
-    # ._acks_pend. Note messages in ._lines have no trailing \n.
-    def _process_str(self, l):
-        l = [x for x in l if x]  # Discard ka's
-        self._acks_pend -= {int(x, 16) for x in l if len(x) == 2}
-        lines = [x for x in l if len(x) != 2]  # Lines received
-        if lines:
-            self._lines.extend(lines)
-            for line in lines:
-                asyncio.create_task(self._sendack(int(line[0:2], 16)))
-
-    async def _sendack(self, mid):
-        async with self._wlock:
-            await self._send('{:02x}\n'.format(mid))
-
-    async def _keepalive(self):
-        while True:
-            await self._vwrite(None)
-            await asyncio.sleep(self._tim_ka)
-
-    async def write(self, line, qos=True, wait=True):
-        if qos and wait:
-            while self._acks_pend:
-                await asyncio.sleep(TIM_TINY)
-        fstr =  '{:02x}{}' if line.endswith('\n') else '{:02x}{}\n'
-        mid = next(self._getmid)
-        self._acks_pend.add(mid)
-        # ACK will be removed from ._acks_pend by ._read
-        line = fstr.format(mid, line)  # Local copy
-        await self._vwrite(line)  # Write verbatim
-        if not qos:  # Don't care about ACK. All done.
-            return
-        # qos: pause until ACK received
-        while True:
-            await self._status_coro()  # Wait for outage to clear
-            if await self._waitack(mid):
-                return  # Got ack, removed from ._acks_pend, all done
-            # Either timed out or an outage started
-            await self._vwrite(line)  # Waits for outage to clear
-            self._verbose and print('Repeat', line[2:], 'to server app')
-
-    # When ._read receives an ACK it is discarded from ._acks_pend. Wait for
-    # this to occur (or an outage to start). Currently use system timeout.
-    async def _waitack(self, mid):
-        tstart = time.time()  # Wait for ACK
-        while mid in self._acks_pend:
-            await asyncio.sleep(TIM_TINY)
-            if not self() or ((time.time() - tstart) > self._to_secs):
-                self._verbose and print('waitack timeout', mid)
-                return False  # Outage or ACK not received in time
+    # Relay mode: queue messages for the peer as received, adjusting only the
+    # newline if the framing differs. A message is acknowledged once queued.
+    # If the peer is unknown, its send queue is full or its link can't carry
+    # the message it is not acknowledged so the client retransmits it later.
+    def _relay(self, msgs):
+        client_id, qos = self._fwd
+        peer = Connection._conns.get(client_id)
+        binary = self._opts & OPT_BINARY
+        for mid, msg in msgs:
+            if peer is None or peer._full() or not peer._fits(msg, binary):
+                continue
+            if not mid:  # Client has power cycled
+                self._isnew(-1)
+            if self._isnew(mid):
+                peer._forward(msg, binary, qos)
+            self._ack(mid)
+
+    # True if a message received from a client with the given framing can be
+    # sent on this link. A binary payload containing a newline can't be sent
+    # as a line of text and a frame is limited to 0xffff bytes.
+    def _fits(self, msg, binary):
+        if self._opts & OPT_BINARY:
+            if len(msg) - (not binary) <= 0xffff:
+                return True
+            self._verbose and print('Message too long to relay to', self._cl_id)
+        elif not binary or b'\n' not in msg:
+            return True
+        else:
+            self._verbose and print('Message with a newline not relayed to', self._cl_id)
+        return False
+
+    # Queue a message received from a client with the given framing. Only the
+    # newline is adjusted, if the framing of this link differs. The caller
+    # checks ._fits.
+    def _forward(self, msg, binary, qos):
+        pbin = self._opts & OPT_BINARY
+        if pbin != binary:
+            msg = msg[:-1] if pbin else msg + b'\n'
+        self._put(_Pend(msg, qos, qos, None))
+
+    # Broker: handle requests. '>topic\tpayload' publishes 'topic\tpayload',
+    # '+topic' subscribes and '-topic' unsubscribes. A request which is not
+    # valid, for example because its topic is not UTF-8, is returned as an
+    # ordinary message for .readline.
+    def _route(self, reqs):
+        rest = []
+        binary = self._opts & OPT_BINARY
+        for mid, req in reqs:
+            cmd = req[:1]
+            body = req[1:] if binary else req[1:-1]  # Without newline
+            i = body.find(b'\t') if cmd == b'>' else len(body)
+            try:
+                topic = str(body[:i], 'utf8')
+            except UnicodeError:
+                i = -1
+            if i <= 0 or cmd not in (b'>', b'+', b'-'):
+                rest.append((mid, req if binary else b'\t' + req))
+                continue
+            if not mid:  # Client has power cycled
+                self._isnew(-1)
+            if self._isnew(mid):
+                if cmd == b'>':
+                    Connection._publish(topic, req[1:], binary)
+                elif cmd == b'+':
+                    Connection.subscribe(self._cl_id, topic)
+                else:
+                    Connection.unsubscribe(self._cl_id, topic)
+            self._ack(mid)
+        return rest
+
+    # Acknowledge a received message.
+    def _ack(self, mid):
+        if self._opts & (OPT_ACKBATCH | OPT_BINARY):
+            self._ackq.append(mid)  # Formatted when the output is flushed
+        else:
+            self._obuf += '{}\n'.format(self._mfmt.format(mid)).encode()
+
+    # If key is not None a message with the same key which is unsent or
+    # unacknowledged is discarded, the new message taking its place. The
+    # superseded write returns at once. A message not acknowledged within ttl
+    # ms is discarded. Return False if the message was discarded.
+    async def write(self, line, qos=True, wait=True, key=None, pri=PRI_NORMAL,
+                    ttl=0):
+        return await self._write(_encode(line, self._opts & OPT_BINARY), qos,
+                                 wait, key, pri, ttl)
+
+    # With OPT_BINARY buf may contain any bytes. Otherwise it is sent as a
+    # line of text.
+    async def write_bytes(self, buf, qos=True, wait=True, key=None,
+                          pri=PRI_NORMAL, ttl=0):
+        if not (self._opts & OPT_BINARY or buf.endswith(b'\n')):
+            buf += b'\n'
+        return await self._write(buf, qos, wait, key, pri, ttl)
+
+    # Queue a message without pausing. Return False if the send queue is full.
+    # A qos message is retransmitted until acknowledged.
+    def try_write(self, line, qos=True, key=None, pri=PRI_NORMAL, ttl=0):
+        if self._full(key):
+            return False
+        line = _encode(line, self._opts & OPT_BINARY)
+        self._put(_Pend(self._chklen(line), qos, qos, None, key, pri, ttl))
         return True
 
-    # Verbatim write: add no message ID.
-    async def _vwrite(self, line):
-        ok = False
-        while not ok:
-            if self._verbose and not self():
-                print('Writer Client:', self._cl_id, 'awaiting OK status')
-            await self._status_coro()
-            if line is None:
-                line = '\n'  # Keepalive. Send now: don't care about loss
+    async def _write(self, line, qos, wait, key=None, pri=PRI_NORMAL, ttl=0):
+        self._chklen(line)
+        # Pause while the send queue is full
+        while self._full(key):
+            if self._evq is None:
+                self._evq = asyncio.Event()
+            self._evq.clear()
+            await self._evq.wait()
+        ev = asyncio.Event() if qos else None
+        pend = _Pend(line, qos, qos and wait, ev, key, pri, ttl)
+        self._put(pend)
+        if qos:  # Pause until ACK received. ._retx handles retransmission.
+            await ev.wait()
+        return pend.line is not None
+
+    # True if the send queue is full. A message which replaces a queued one
+    # with the same key does not lengthen the queue.
+    def _full(self, key=None):
+        if self._qfull or len(self._txq) >= self._qmax:
+            old = None if key is None else self._keys.get(key)
+            return old is None or old.mid is not None
+        return False
+
+    def _chklen(self, line):
+        if self._opts & OPT_BINARY and len(line) > 0xffff:
+            raise ValueError('Message too long.')
+        return line
+
+    def _put(self, pend):
+        q = self._txq
+        self.lanes[pend.pri].depth += 1
+        if pend.ttl:
+            self._nttl += 1
+        key = pend.key
+        if key is not None:  # Conflate
+            old = self._keys.get(key)
+            self._keys[key] = pend
+            if old is not None:
+                self._unkey(old)
+                self._discard(old)  # Superseded writer returns
+                if old.mid is None:  # Unsent
+                    i = q.index(old)
+                    if old.pri == pend.pri:  # Take its place in the queue
+                        q[i] = pend
+                        if old.win != pend.win:
+                            self._nfree += 1 if old.win else -1
+                        self._pump()
+                        return
+                    self._unqueue(i)
+                else:
+                    self._acks_pend.pop(old.mid, None)  # Stop retransmission
+        if pend.pri:  # Behind other PRI_HIGH messages, ahead of the rest
+            q.insert(self._nhi, pend)
+            self._nhi += 1
+        else:
+            q.append(pend)
+        if not pend.win:
+            self._nfree += 1
+        if len(q) >= self._qmax:
+            self._qfull = True
+        self._pump()
+
+    # A message has been acknowledged (or sent if not qos). Update its lane
+    # statistics. A keyed message can no longer be replaced.
+    def _done(self, pend, t):
+        lane = self.lanes[pend.pri]
+        lane.depth -= 1
+        lane.sample(_tdiff(t, pend.tq))
+        self._unkey(pend)
+
+    def _unkey(self, pend):
+        if pend.ttl:
+            self._nttl -= 1
+        if pend.key is not None and self._keys.get(pend.key) is pend:
+            del self._keys[pend.key]
+
+    # A message is discarded before delivery: its writer returns False.
+    def _discard(self, pend):
+        self.lanes[pend.pri].depth -= 1
+        pend.line = None
+        if pend.ev is not None:
+            pend.ev.set()
+
+    def _expire(self, pend):
+        self._verbose and print('Message expired: not sent to', self._cl_id)
+        self.lanes[pend.pri].expired += 1
+        self._unkey(pend)
+        self._discard(pend)
+
+    # Discard expired messages from the send queue and from those awaiting an
+    # ACK.
+    def _purge(self, t):
+        if not self._nttl:
+            return
+        q = self._txq
+        i = 0
+        while i < len(q):
+            pend = q[i]
+            if pend.expired(t):
+                self._unqueue(i)
+                self._expire(pend)
             else:
-                # Aawait client ready after initial or subsequent connection
-                while self._wr_pause:
-                    await asyncio.sleep(self._tim_short)
+                i += 1
+        apend = self._acks_pend
+        for mid in [mid for mid, pend in apend.items() if pend.expired(t)]:
+            self._expire(apend.pop(mid))
+        self._chkq()
 
-            async with self._wlock:  # >1 writing task?
-                ok = await self._send(line)  # Fail clears status
+    def _unqueue(self, i):
+        pend = self._txq.pop(i)
+        self._nhi -= pend.pri
+        self._nfree -= not pend.win
 
-    # Send a string. Return True on apparent success, False on failure.
-    async def _send(self, d):
-        if not self():
-            return False
-        d = d.encode('utf8')  # Socket requires bytes
-        start = time.time()
-        while d:
-            try:
-                ns = self._sock.send(d)  # Raise OSError if client fails
-            except OSError as e:
-                err = e.args[0]
-                if err == errno.EAGAIN:  # Would block: try later
-                    await asyncio.sleep(0.1)
+    # Release paused writers at the low watermark.
+    def _chkq(self):
+        if self._qfull and len(self._txq) <= self._qlow:
+            self._qfull = False
+            if self._evq is not None:
+                self._evq.set()
+
+    # Move messages from the send queue to the output buffer, subject to link
+    # status and the window. Messages not subject to the window (qos0 or
+    # wait=False) may overtake those which are held. PRI_HIGH messages may
+    # use the whole ID space.
+    def _pump(self):
+        q = self._txq
+        if not q or not self() or self._wr_pause:
+            return
+        binary = self._opts & OPT_BINARY
+        maxwin = WINDOW16 if self._opts & OPT_MID16 else WINDOW
+        apend = self._acks_pend
+        n = len(q)
+        t = _ms()
+        i = 0
+        while i < len(q):
+            pend = q[i]
+            if pend.expired(t):
+                self._unqueue(i)
+                self._expire(pend)
+                continue
+            if pend.win:
+                if len(apend) >= (maxwin if pend.pri else self._win):  # Full
+                    if not self._nfree:
+                        break
+                    i += 1
                     continue
-                break
             else:
-                d = d[ns:]
-                if d:
-                    await asyncio.sleep(self._tim_short)
-                    if (time.time() - start) > self._to_secs:
-                        break
-        else:
-            # The 0.2s delay is necessary otherwise messages can be lost if the
-            # app attempts to send them in quick succession. Also occurs on
-            # Pyboard D despite completely different hardware.
-            # Is it better to return immediately and delay subsequent writes?
-            # Should the delay be handled at a higher level?
-            #await asyncio.sleep(0.2)  # Disallow rapid writes: result in data loss
-            return True  # Success
-        self._close('Write fail: closing connection.')
-        return False
+                self._nfree -= 1
+            del q[i]
+            self._nhi -= pend.pri
+            mid = next(self._getmid)
+            line = pend.line
+            if binary:
+                line = frame(FT_MSG, mid, line)
+            else:  # Payload is shared: only the ID is formatted per message
+                line = self._mfmt.format(mid).encode() + line
+            pend.mid = mid
+            if pend.qos:  # ACK will be removed from ._acks_pend by ._rxed
+                pend.line = line
+                pend.t = t
+                apend[mid] = pend
+            else:
+                self._done(pend, t)
+            self._obuf += line
+        if len(q) == n:  # Nothing sent
+            return
+        if apend:
+            Connection._rtq.add(self)
+        self._kick()
+        self._chkq()
+
+    # Called by the timer wheel: retransmit qos messages whose ACK is overdue.
+    # The timeout is based on the measured RTT and doubles with each retry.
+    # Expired messages are discarded rather than retransmitted. After an
+    # outage ._activate retransmits. Return False if no ACKs are awaited.
+    def _retx(self, t):
+        self._purge(t)
+        if not self._acks_pend:
+            return False
+        if self._wr_pause or not self():
+            return True
+        rtt = self.rtt
+        kick = False
+        for mid, pend in self._acks_pend.items():
+            if _tdiff(t, pend.t) >= rtt.timeout(pend.n):
+                pend.t = t
+                pend.n += 1
+                self._obuf += pend.line
+                kick = True
+                self._verbose and print('Repeat', mid, 'to server app')
+        if kick:
+            self._kick()
+        return True
+
+    # Ensure queued data is sent. Everything queued before the flush occurs
+    # goes out in a single send. Without a flush delay the flush occurs after
+    # tasks which are ready have run. Under MicroPython a task stands in for
+    # call_soon. With a flush delay ._io sends.
+    def _kick(self):
+        self._txd = True
+        if upython:
+            if not self._flush_s and self._flush_h is None:
+                self._flush_h = asyncio.create_task(self._soon())
+        elif self._flush_h is None and not self._wrwait:
+            if self._flush_s:
+                self._flush_h = self._loop.call_later(self._flush_s, self._flush)
+            else:  # Flush after all ready callbacks and tasks have run
+                self._flush_h = self._loop.call_soon(self._flush)
+
+    async def _soon(self):
+        await asyncio.sleep(0)
+        self._flush()
+
+    def _outdata(self):
+        if self._ackq:  # Acknowledge all received messages
+            if self._opts & OPT_BINARY:
+                self._obuf += ackframe(self._ackq)
+            else:  # OPT_ACKBATCH
+                self._obuf += ackfmt(self._ackq, self._mfmt).encode()
+            self._ackq = []
+        return self._obuf
+
+    # Send as much as the socket will accept. If it can't take it all the
+    # CPython event loop calls again when the socket becomes writeable. Under
+    # MicroPython ._io retries.
+    def _flush(self):
+        self._flush_h = None
+        if not self():
+            return
+        buf = self._outdata()
+        try:
+            n = self._sock.send(buf)  # Raise OSError if client fails
+        except OSError as e:
+            if e.args[0] != errno.EAGAIN:  # Would block: try later
+                self._close('Write fail: closing connection.')
+                return
+            n = 0
+        if n:
+            buf = buf[n:]  # MicroPython bytearray has no slice deletion
+            self._obuf = buf
+        if upython:
+            return
+        if buf and not self._wrwait:
+            self._wrwait = True
+            self._loop.add_writer(self._sock, self._flush)
+        elif not buf and self._wrwait:
+            self._wrwait = False
+            self._loop.remove_writer(self._sock)
 
     def __getitem__(self, client_id):  # Return a Connection of another client
         return Connection._conns[client_id]
@@ -387,9 +1235,23 @@ class Connection:
         if self._sock is not None:
             self._verbose and print('fail detected')
             self._verbose and reason and print('Reason:', reason)
+            if not upython:
+                self._loop.remove_reader(self._sock)
+                if self._wrwait:
+                    self._wrwait = False
+                    self._loop.remove_writer(self._sock)
             self._sock.close()
             self._sock = None
+            self._obuf = bytearray()  # Discard data queued for dead socket
+            self._ackq = []
+            if Connection._on_disconnect is not None:
+                _launch(Connection._on_disconnect, self)
 
 # API aliases
 client_conn = Connection.client_conn
 wait_all = Connection.wait_all
+broadcast = Connection.broadcast
+subscribe = Connection.subscribe
+unsubscribe = Connection.unsubscribe
+subscribers = Connection.subscribers
+publish = Connection.publish